@@ -0,0 +1,232 @@
+import asyncio
+import codecs
+import collections
+import os
+import re
+import signal
+import time
+
+import pexpect
+
+################### Defined constants ##################################
+# Bytes read from a node at a time
+READ_SIZE = 65536
+
+################### Nodes ###################################
+
+class AsyncNode:
+    '''Output of a program read on the running event loop as it arrives,
+    whichever node is being awaited. Unmatched output is matched like
+    pexpect with expect() and readline(). Pattern lists may hold pexpect.EOF
+    and pexpect.TIMEOUT, whose index is returned instead of raising.'''
+
+    def __init__(self, fd, proc=None, owner=None, timeout=30, logfile=None):
+        self.fd = fd
+        self.proc = proc
+        self.owner = owner  # Node of an in-process program, see attach()
+        self.pid = None if proc is None else proc.pid
+        self.timeout = timeout
+        self.logfile = logfile
+        self.logfile_read = None
+        self.linesep = '\n'
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+        self.buffer = ''  # Output not yet matched
+        self.offset = 0  # Position of buffer in all output
+        self.chunks = collections.deque()  # (end position, arrival time) of output in buffer
+        self.match = None
+        self.arrival = None  # Arrival of the output matched last
+        self.error = None
+        self.eof = False
+        self.changed = asyncio.Event()
+
+        self.exitstatus = None
+        self.signalstatus = None
+        asyncio.get_running_loop().add_reader(fd, self.readable)
+
+    def readable(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError:  # EIO once every copy of the pty is closed
+            data = b''
+        now = time.perf_counter()
+        self.changed.set()
+        if len(data) == 0:
+            self.eof = True
+            asyncio.get_running_loop().remove_reader(self.fd)
+            return
+
+        try:
+            text = self.decoder.decode(data)
+        except UnicodeDecodeError as err:
+            # Raised by the next wait, like a pexpect read
+            self.error = err
+            self.decoder.reset()
+            return
+        for log in (self.logfile, self.logfile_read):
+            if log is not None:
+                log.write(text)
+                log.flush()
+
+        self.buffer += text
+        self.chunks.append((self.offset + len(self.buffer), now))
+
+    def consume(self, end):
+        # Removes buffer up to end, the arrival is when its last character
+        # was read
+        position = self.offset + end
+        while self.chunks and self.chunks[0][0] < position:
+            self.chunks.popleft()
+        if self.chunks:
+            self.arrival = self.chunks[0][1]
+            if self.chunks[0][0] == position:
+                self.chunks.popleft()
+        self.buffer = self.buffer[end:]
+        self.offset = position
+
+    def take(self):
+        # Removes and returns all of buffer
+        text = self.buffer
+        self.consume(len(text))
+        return text
+
+    def unread(self, text):
+        # Puts text back at the start of buffer, arriving with what was
+        # matched last
+        if len(text) == 0:
+            return
+        self.chunks.appendleft((self.offset, self.arrival))
+        self.buffer = text + self.buffer
+        self.offset -= len(text)
+
+    async def wait(self, deadline):
+        # False once deadline passes without new output or the end of output
+        if self.error is not None:
+            err, self.error = self.error, None
+            raise err
+        if self.eof:
+            return False
+        self.changed.clear()
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            # Output already written is still read
+            await asyncio.sleep(0)
+            return self.changed.is_set()
+        try:
+            await asyncio.wait_for(self.changed.wait(), remaining)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def expect(self, patterns, timeout=-1):
+        # Index of the pattern matching earliest in the output, the first
+        # listed on ties
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            found = [(m.start(), i, m) for i, p in enumerate(patterns)
+                     if isinstance(p, re.Pattern) and (m := p.search(self.buffer)) is not None]
+            if found:
+                _, i, self.match = min(found, key=lambda f: f[:2])
+                self.consume(self.match.end())
+                return i
+            if not await self.wait(deadline):
+                outcome = pexpect.EOF if self.eof else pexpect.TIMEOUT
+                if outcome in patterns:
+                    self.match = outcome
+                    return patterns.index(outcome)
+                raise outcome('')
+
+    async def readline(self, timeout=-1):
+        # Next line without the line ending, None on timeout, raises
+        # pexpect.EOF once all complete lines are read
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            end = self.buffer.find('\r\n')
+            if end != -1:
+                line = self.buffer[:end]
+                self.consume(end + 2)
+                return line
+            if not await self.wait(deadline):
+                if self.eof:
+                    raise pexpect.EOF('')
+                return None
+
+    def send(self, s):
+        if self.logfile is not None:
+            self.logfile.write(s)
+            self.logfile.flush()
+        data = s.encode()
+        while len(data) > 0:
+            data = data[os.write(self.fd, data):]
+
+    def sendline(self, s=''):
+        self.send(s + self.linesep)
+
+    def isalive(self):
+        if self.owner is not None:
+            return self.owner.isalive()
+        if self.proc is not None:
+            return self.proc.returncode is None
+        return not self.eof
+
+    async def wait_exit(self, timeout):
+        # False if the program is still running after timeout
+        if self.proc is None:
+            deadline = time.monotonic() + timeout
+            while self.isalive():
+                if not await self.wait(deadline):
+                    return not self.isalive()
+            return True
+        try:
+            status = await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if status < 0:
+            self.signalstatus = -status
+        else:
+            self.exitstatus = status
+        return True
+
+    def terminate(self, force=False):
+        # Also called at exit, after the event loop is closed
+        if self.owner is not None:
+            return self.owner.terminate(force)
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                os.kill(self.proc.pid, signal.SIGKILL if force else signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        return True
+
+    def close(self):
+        if self.fd == -1:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self.fd)
+        except RuntimeError:  # No running loop
+            pass
+        os.close(self.fd)
+        self.fd = -1
+
+async def spawn(command, args, cwd=None, timeout=30, logfile=None):
+    # Runs command on a new pty, like pexpect.spawn
+    master, slave = os.openpty()
+    try:
+        proc = await asyncio.create_subprocess_exec(command, *args, cwd=cwd, stdin=slave, stdout=slave,
+                                                    stderr=slave, start_new_session=True)
+    except OSError:
+        os.close(master)
+        raise
+    finally:
+        os.close(slave)
+
+    return AsyncNode(master, proc=proc, timeout=timeout, logfile=logfile)
+
+def attach(node, logfile=None):
+    # Output of an in-process pexpect node, such as a py_registry node,
+    # read through its fd instead
+    return AsyncNode(node.child_fd, owner=node, timeout=node.timeout, logfile=logfile)
@@ -1,13 +1,32 @@
+import asyncio
 import atexit
+import collections
+import errno
+import fcntl
+import functools
+import json
 import os
 import random
+import re
+import select
 import shutil
+import signal
 import stat
-import string
 import sys
 import tempfile
+import time
 import pexpect
-import filecmp
+import hashlib
+import heapq
+import inspect
+import async_node
+import corpus
+import protocol
+import py_peer
+import py_registry
+import stats
+import synthetic
+import wire_proxy
 
 ################### Exception/Error classes ############################
 # Base class for all errors
@@ -44,39 +63,631 @@ class TestError(TestingErrorBase):
 class EndTestsException(Exception):
     pass
 
+################### Run report functions ###############################
+
+class Phase:
+    def __init__(self, name, depth):
+        self.name = name
+        self.title = None
+        self.depth = depth
+        self.start = time.perf_counter()
+        self.wall = None
+        self.blocked = 0.0
+        self.first_output = None
+        self.status = 'running'
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'title': self.title,
+            'depth': self.depth,
+            'status': self.status,
+            'error': self.error,
+            'wall_seconds': self.wall,
+            'blocked_seconds': self.blocked,
+            'first_output_seconds': self.first_output,
+        }
+
+def timed_phase(func):
+    # Records the wall time of each call, the time spent blocked waiting for
+    # node output, and when the first relevant output arrived. Test steps,
+    # see step, are timed while they run.
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def step_wrapper(*args, **kwargs):
+            phase = begin_phase(func)
+            try:
+                result = yield from func(*args, **kwargs)
+            except BaseException as err:
+                end_phase(phase, err)
+                raise
+            end_phase(phase)
+            return result
+        return step_wrapper
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            phase = begin_phase(func)
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException as err:
+                end_phase(phase, err)
+                raise
+            end_phase(phase)
+            return result
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        phase = begin_phase(func)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as err:
+            end_phase(phase, err)
+            raise
+        end_phase(phase)
+        return result
+    return wrapper
+
+def begin_phase(func):
+    phase = Phase(func.__name__, len(phase_stack))
+    phases.append(phase)
+    phase_stack.append(phase)
+    return phase
+
+def end_phase(phase, err=None):
+    if err is None:
+        phase.status = 'passed'
+    else:
+        phase.status = 'failed'
+        phase.error = str(err) or type(err).__name__
+    phase.wall = time.perf_counter() - phase.start
+    phase_stack.pop()
+
+def instrument(node):
+    # Charge the time a node spends waiting for output to the current phases,
+    # and timestamp the output read, see arrival()
+    read = node.read_nonblocking
+    instrumented.append(node)
+
+    def timed_read(size=1, timeout=-1):
+        start = time.perf_counter()
+        if timeout == -1:
+            timeout = node.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                wait_output(node, None if deadline is None else max(0, deadline - time.monotonic()))
+                try:
+                    data = read(size, 0)
+                    arrivals[node] = waiting.pop(node, None) or time.perf_counter()
+                    return data
+                except pexpect.TIMEOUT:
+                    # Woken by output read elsewhere, such as registry
+                    # lines drained by a wire node
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise
+        finally:
+            elapsed = time.perf_counter() - start
+            for phase in phase_stack:
+                phase.blocked += elapsed
+
+    node.read_nonblocking = timed_read
+
+def arrival(node):
+    # When the output last read from node arrived. Output that arrived while
+    # another node was waited on is timestamped when it arrived, not when
+    # it was read.
+    if isinstance(node, async_node.AsyncNode):
+        return node.arrival
+    return arrivals.get(node)
+
+################### Result cache functions ###############################
+# Phases marked reusable do not change the state of any node, so with the
+# same executables and seed a call that passed in an earlier run is skipped
+# and its pass reused. The phases that change state always run.
+
+def reusable(func):
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def step_wrapper(*args, **kwargs):
+            signature = phase_signature(func, args, kwargs)
+            if reuse_pass(func, signature):
+                return None
+            result = yield from func(*args, **kwargs)
+            reused_passes.add(signature)
+            return result
+        return step_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        signature = phase_signature(func, args, kwargs)
+        if reuse_pass(func, signature):
+            return None
+        result = func(*args, **kwargs)
+        reused_passes.add(signature)
+        return result
+    return wrapper
+
+def reuse_pass(func, signature):
+    # True if the call passed in an earlier run, recorded as a cached phase
+    if signature not in cached_passes:
+        return False
+    phase = Phase(func.__name__, len(phase_stack))
+    phase.status = 'cached'
+    phase.wall = 0.0
+    phases.append(phase)
+    phase_stack.append(phase)
+    banner(f'Reusing the earlier pass of {signature}')
+    phase_stack.pop()
+    reused_passes.add(signature)
+    return True
+
+def phase_signature(func, args, kwargs):
+    # Name and arguments of a phase call, nodes are left out. Repeated
+    # identical calls are numbered.
+    values = [a for a in args if not isinstance(a, NODE_TYPES)]
+    values += [f'{k}={v}' for k, v in sorted(kwargs.items())
+               if not isinstance(v, NODE_TYPES)]
+    text = f'{func.__name__} {json.dumps(values, default=str)}'
+    signature_counts[text] = signature_counts.get(text, 0) + 1
+    if signature_counts[text] > 1:
+        text += f' #{signature_counts[text]}'
+    return text
+
+def result_key(required_exes, base_exes, seed):
+    # Hash of the built executables, the registry used, the harness, the
+    # seed, and every option that changes what the tests check
+    options = dict(check_options, settle=settle_timeout, wire=use_wire_proxy, split=split_responses,
+                   py_registry=use_py_registry, debug=debug_output)
+    digest = hashlib.sha256()
+    digest.update(f'{seed}\0{json.dumps(options, sort_keys=True)}\0'.encode())
+    paths = [os.path.abspath(f) for f in required_exes]
+    if not use_py_registry:
+        paths += base_exes
+    # The calling script is next to this one
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    paths += [os.path.join(script_dir, f) for f in HARNESS_SOURCES + [os.path.basename(sys.argv[0])]]
+    for path in paths:
+        digest.update(os.path.basename(path).encode() + b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+def load_results(required_exes, base_exes, seed, use_cache):
+    # Passes of earlier runs with the same key are reused unless use_cache
+    # is False, the passes of this run are stored when it ends
+    path = os.path.join(RESULT_CACHE_DIR, result_key(required_exes, base_exes, seed) + '.json')
+    if use_cache:
+        try:
+            with open(path) as f:
+                cached_passes.update(json.load(f)['passes'])
+        except (OSError, ValueError, KeyError):
+            pass
+    atexit.register(store_results, path)
+
+def store_results(path):
+    # The cache is an optimization, ignore any problems
+    try:
+        write_cache_file(path, {'passes': sorted(reused_passes)})
+    except OSError:
+        pass
+
+def submission_key(argv):
+    # The script and the files it was given
+    text = '\0'.join([os.path.basename(argv[0])] + sorted(map(os.path.abspath, argv[1:])))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def load_seed(path):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def store_seed(path, seed):
+    # Kept while a test fails, a pass starts over with new seeds. A run
+    # stopped before testing, such as by validation or the build, keeps
+    # no seed.
+    try:
+        if run_report['result'] == 'passed':
+            os.remove(path)
+        elif any(p.status == 'failed' and p.name != 'initial_setup' for p in phases):
+            write_cache_file(path, seed)
+    except OSError:
+        pass
+
+def write_cache_file(path, value):
+    # Written to a private file and renamed into place so concurrent runs
+    # never read a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.partial-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f)
+    os.replace(partial, path)
+
+################### Liveness functions ###############################
+
+class Watch:
+    '''Child process of a spawned node, watched through a pidfd. While armed,
+    its exit ends waits on other nodes with msg.'''
+
+    def __init__(self, node, msg, soln):
+        self.node = node
+        self.msg = msg
+        self.soln = soln
+        self.armed = True
+        try:
+            self.pidfd = os.pidfd_open(node.pid)
+        except (AttributeError, OSError):
+            self.pidfd = None
+
+    def exited(self, timeout=0):
+        # Returns as soon as the process exits
+        if self.pidfd is not None:
+            return len(select.select([self.pidfd], [], [], timeout)[0]) > 0
+        deadline = time.monotonic() + timeout
+        while self.node.isalive():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(LIVENESS_POLL_INTERVAL)
+        return True
+
+    def describe(self):
+        self.node.isalive()  # Collects the exit status
+        if self.node.signalstatus is not None:
+            return f'killed by {signal.Signals(self.node.signalstatus).name}'
+        return f'exit status {self.node.exitstatus}'
+
+def watch(node, msg, soln=False):
+    # Nodes without a child process are only checked with isalive()
+    if getattr(node, 'pid', None) is not None:
+        watched[node] = Watch(node, msg, soln)
+
+def disarm(node):
+    # The node is expected to exit
+    if node in watched:
+        watched[node].armed = False
+
+def node_exited(node, timeout=0):
+    if node in watched:
+        return watched[node].exited(timeout)
+    deadline = time.monotonic() + timeout
+    while node.isalive():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(LIVENESS_POLL_INTERVAL)
+    return True
+
+def wait_output(node, timeout):
+    # Waits until node has output, or another armed node exits. Other
+    # instrumented nodes with new output are noted in waiting.
+    fds = node.wait_fds() if hasattr(node, 'wait_fds') else [node.child_fd]
+    others = {w.pidfd: w for w in watched.values()
+              if w.armed and w.node is not node and w.pidfd is not None}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        quiet = {n.child_fd: n for n in instrumented
+                 if n is not node and n not in waiting and n.child_fd not in fds and n.child_fd != -1}
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        ready = select.select(fds + list(others) + list(quiet), [], [], remaining)[0]
+        now = time.perf_counter()
+        for fd in ready:
+            if fd in others:
+                died(others[fd])
+            elif fd in quiet:
+                waiting[quiet[fd]] = now
+        if len(ready) == 0 or any(fd in fds for fd in ready):
+            return
+
+def died(w):
+    w.armed = False
+    msg = f'{w.msg}, {w.describe()}.'
+    if w.soln:
+        raise InternalError(msg)
+    perror(msg)
+    raise EndTestsException()
+
+def listening(port):
+    # None when the listening sockets cannot be read
+    found = None
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == TCP_LISTEN and int(fields[1].rsplit(':', 1)[1], 16) == port:
+                        return True
+            found = False
+        except OSError:
+            pass
+    return found
+
+def wait_listening(node, port, timeout):
+    # Waits until node accepts connections on port, raises
+    # AbnormalTerminationError if it exits first
+    deadline = time.monotonic() + timeout
+    while True:
+        ready = listening(port)
+        if ready is None:
+            # Unable to tell, allow the old startup delay
+            ready = not node_exited(node, STARTUP_DELAY)
+        if ready or time.monotonic() >= deadline:
+            break
+        if node_exited(node, LIVENESS_POLL_INTERVAL):
+            break
+    verify_alive(node)
+
+def note_output():
+    # The output a phase is waiting for has arrived
+    now = time.perf_counter()
+    for phase in phase_stack:
+        if phase.first_output is None:
+            phase.first_output = now - phase.start
+
+def set_result(result):
+    run_report['result'] = result
+
+def write_report(path):
+    run_report['total_seconds'] = time.perf_counter() - run_start
+    run_report['phases'] = [p.to_dict() for p in phases]
+    run_report['search_latency'] = {leg: hist.to_dict() for leg, hist in latencies.items()}
+    run_report['downloads'] = [d.to_dict() for d in downloads]
+    run_report['staging'] = dict(staged)
+    run_report['synthesized'] = {name: f.to_dict() for name, f in synthesized.items()}
+    with open(path, 'w') as f:
+        json.dump(run_report, f, indent=2)
+
+################### Output capture functions ###############################
+# Without -d the output of every node is kept in a small ring, and printed
+# interleaved by time when a test fails
+
+class OutputRing:
+    '''Most recent output read from a node, at most OUTPUT_RING_SIZE
+    characters in timestamped chunks. Set as the logfile_read of a node.'''
+
+    def __init__(self, node, name):
+        self.node = node
+        self.name = name
+        self.chunks = collections.deque()
+        self.size = 0
+        self.arrival = None  # Set while draining output that arrived earlier
+
+    def write(self, text):
+        self.chunks.append((self.arrival or time.perf_counter(), text))
+        self.size += len(text)
+        while self.size > OUTPUT_RING_SIZE and len(self.chunks) > 1:
+            self.size -= len(self.chunks.popleft()[1])
+
+    def flush(self):
+        pass
+
+    def lines(self):
+        # (arrival, name, line) of each line, a line arrives with its first
+        # character
+        start = None
+        line = ''
+        for when, text in self.chunks:
+            for part in re.split(r'(\n)', text):
+                if part == '\n':
+                    yield (start, self.name, line.rstrip('\r'))
+                    start = None
+                    line = ''
+                elif part:
+                    if start is None:
+                        start = when
+                    line += part
+        if line:
+            yield (start, self.name, line)
+
+def capture(node, name):
+    ring = OutputRing(node, name)
+    node.logfile_read = ring
+    rings.append(ring)
+
+def drain(ring):
+    # Output written but not yet read is captured too, read without the
+    # timing and liveness checks of instrument. Its arrival is when it was
+    # first seen waiting, if it was.
+    node = ring.node
+    if not isinstance(node, pexpect.spawnbase.SpawnBase):
+        return
+    ring.arrival = waiting.pop(node, None)
+    try:
+        while True:
+            type(node).read_nonblocking(node, node.maxread, 0)
+    except (pexpect.TIMEOUT, pexpect.EOF, OSError, ValueError):
+        pass
+    finally:
+        ring.arrival = None
+
+def dump_output():
+    # The output already printed with -d is not repeated
+    if debug_output:
+        return
+    for ring in rings:
+        drain(ring)
+    if not any(ring.chunks for ring in rings):
+        return
+    banner('Recent program output')
+    width = max(len(ring.name) for ring in rings)
+    for when, name, line in heapq.merge(*(ring.lines() for ring in rings)):
+        print(f'{when - run_start:9.3f} {name:>{width}} | {line}')
+
+################### SEARCH latency functions ###############################
+# Each SEARCH test is timed from sending the filename to the program, to
+# the SEARCH line of the registry, to the response line of the program
+
+def mark(name, when=None):
+    search_marks[name] = time.perf_counter() if when is None else when
+
+def record_search_latency():
+    sent = search_marks.get('sent')
+    registry = search_marks.get('registry')
+    response = search_marks.get('response')
+    search_marks.clear()
+    if None in (sent, registry, response):
+        return
+    latencies['client_to_registry'].record(registry - sent)
+    latencies['registry_to_response'].record(response - registry)
+    latencies['end_to_end'].record(response - sent)
+
+def print_latencies():
+    if latencies['end_to_end'].count == 0:
+        return
+    banner('SEARCH latency')
+    rows = []
+    for leg, hist in latencies.items():
+        summary = hist.to_dict()
+        rows.append([leg, hist.count] + [stats.format_ms(summary[f'{label}_ms'])
+                                         for label, _ in stats.HISTOGRAM_PERCENTILES] +
+                    [stats.format_ms(summary['max_ms'])])
+    stats.print_table(['leg', 'count'] + [f'{label} ms' for label, _ in stats.HISTOGRAM_PERCENTILES] + ['max ms'],
+                      rows)
+
+################### Test step functions ###################################
+# Each test is written once as a generator that yields the node I/O it
+# needs, made by the request functions below, and is given the result. The
+# same test runs with pexpect nodes, each request at once, or with
+# AsyncNodes as a coroutine on the event loop, see async_node.
+
+def step(func):
+    # A test step that runs when called with pexpect nodes, or returns a
+    # coroutine to await when any node is an AsyncNode. Other tests use the
+    # test itself, func.test, with yield from.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        steps = func(*args, **kwargs)
+        if any(isinstance(a, async_node.AsyncNode) for a in args):
+            return run_async(steps)
+        return run(steps)
+    wrapper.test = func
+    return wrapper
+
+def run(steps):
+    # Runs the requests of a test with pexpect nodes. Errors are raised in
+    # the test where the request was yielded.
+    result = None
+    error = None
+    while True:
+        try:
+            request = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        run_request, _, args = request
+        try:
+            result, error = run_request(*args), None
+        except BaseException as err:
+            result, error = None, err
+
+async def run_async(steps):
+    # run for a test with AsyncNodes
+    result = None
+    error = None
+    while True:
+        try:
+            request = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        _, run_request, args = request
+        try:
+            result, error = await run_request(*args), None
+        except BaseException as err:
+            result, error = None, err
+
+def expect(node, patterns, timeout=-1):
+    # Index of the first of patterns found, like pexpect
+    return (node_expect, node_expect_async, (node, patterns, timeout))
+
+def lines(node, handlers, timeout=-1):
+    # Command lines passed to handlers until the step completes, see
+    # dispatch_lines
+    return (dispatch_lines, dispatch_lines_async, (node, handlers, timeout))
+
+def read(node, timeout):
+    # Output not yet matched, waiting up to timeout for some. Empty on
+    # timeout, raises pexpect.EOF at the end of output.
+    return (read_output, read_output_async, (node, timeout))
+
+def alive(node):
+    return (verify_alive, verify_alive_async, (node,))
+
+def dead(node):
+    return (verify_dead, verify_dead_async, (node,))
+
+def together(*steps):
+    # Results of tests, (test, node) pairs, run one after another with
+    # pexpect nodes and at once with AsyncNodes, see run_together_async
+    return (run_together, run_together_async, steps)
+
+def node_expect(node, patterns, timeout):
+    return node.expect(patterns, timeout=timeout)
+
+async def node_expect_async(node, patterns, timeout):
+    return await node.expect(patterns, timeout)
+
+def read_output(node, timeout):
+    if node.buffer:
+        return take(node)
+    try:
+        return node.read_nonblocking(node.maxread, timeout)
+    except pexpect.TIMEOUT:
+        return ''
+
+def run_together(*steps):
+    return [run(test) for test, _ in steps]
+
+def take(node):
+    # Output not yet matched, removed from the node
+    if isinstance(node, async_node.AsyncNode):
+        return node.take()
+    text = node.buffer
+    node.buffer = ''
+    return text
+
+def unread(node, text):
+    # Puts text back before the output not yet matched
+    if isinstance(node, async_node.AsyncNode):
+        node.unread(text)
+    else:
+        node.buffer = text + node.buffer
+
 ################### JOIN functions ###################################
 
+@step
+@timed_phase
 def student_perform_join(reg, node, peer_id):
     banner('Performing JOIN test')
-    student_tx_join(node)
-    soln_rx_join(reg, peer_id)
+    yield together((student_tx_join(node), node), (soln_rx_join(reg, peer_id), reg))
 
+@step
+@timed_phase
 def soln_perform_join(reg, node, peer_id):
     banner('Performing JOIN test')
-    (ip, port) = soln_tx_join(node)
-    student_rx_join(reg, peer_id)
+    (ip, port), _ = yield together((soln_tx_join(node), node), (student_rx_join(reg, peer_id), reg))
 
     return (ip, port)
 
 def student_tx_join(node):
     try:
-        tx_join(node)
+        yield from tx_join(node)
     except AbnormalTerminationError:
         perror('Program unexpectedly closed during JOIN test.')
         raise
 
 def soln_tx_join(node):
     try:
-        tx_join(node)
+        yield from tx_join(node)
         ip = None
         port = None
-        val = node.expect(
-            [
-                PREFIX + r'\s+ADDR\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s*:\s*(\d+)[^\r]*\r\n',
-                pexpect.EOF,
-                ERRFIX + r'\s+([^\r]*)\r\n'
-            ])
+        val = yield expect(node, JOIN_ADDR_PATTERNS)
         if val == 0:  # Address and port
+            note_output()
             ip = node.match.group(1)
             port = int(node.match.group(2))
         elif val == 1:  # EOF
@@ -96,13 +707,13 @@ def soln_tx_join(node):
 def tx_join(node):
     node.sendline('JOIN')
 
-    verify_alive(node)
+    yield alive(node)
 
 def student_rx_join(node, expected_id):
     try:
-        rx_id = rx_join(node)
+        rx_id = yield from rx_join(node)
         if rx_id is None:
-            perror('Recongizable TEST] JOIN statement not printed.')
+            perror('Recognizable TEST] JOIN statement not printed.')
             raise EndTestsException()
         if rx_id != expected_id:
             perror(f'ID {rx_id} printed instead of ID {expected_id}.')
@@ -122,7 +733,7 @@ def student_rx_join(node, expected_id):
 
 def soln_rx_join(node, expected_id):
     try:
-        rx_id = rx_join(node)
+        rx_id = yield from rx_join(node)
         if rx_id is None:
             perror('Recognizable JOIN command not sent.')
             raise EndTestsException()
@@ -141,76 +752,64 @@ def soln_rx_join(node, expected_id):
         raise InternalError(f'Solution printed non-ASCII characters. {err}') from err
 
 def rx_join(node):
-    done = False
     rx_id = None
-    while not done:
-        val = node.expect(
-            [
-                PREFIX + r'\s+JOIN\s+(\d+)\s*\r\n',
-                pexpect.EOF,
-                pexpect.TIMEOUT,
-                PREFIX + r'\s+(\S*)[^\r]*\r\n',
-                ERRFIX + r'\s+([^\r]*)\r\n'
-            ])
-        if val == 0:  # JOIN with peer ID
-            if rx_id is not None:
-                raise DuplicateCommandError()
-            rx_id = int(node.match.group(1))
-        elif val == 1:  # EOF
-            raise AbnormalTerminationError()
-        elif val == 2:  # TIMEOUT
-            done = True
-        elif val == 3:  # Incorrect command
-            raise InvalidCommandError(" ".join(node.after.split()[1:]))
-        elif val == 4:  # Error
-            raise TestError(node.match.group(1))
-        else:  # Error
-            raise InternalError(f'rx_join had expect value {val}.')
 
-    verify_alive(node)
+    def join(args):  # JOIN with peer ID
+        nonlocal rx_id
+        if rx_id is not None:
+            raise DuplicateCommandError()
+        rx_id = int(args.group(1))
+
+    yield lines(node, {'JOIN': join})
+
+    yield alive(node)
 
     return rx_id
 
 ################### PUBLISH functions ###################################
 
+@step
+@timed_phase
 def student_perform_publish(reg, peer, correct_files):
     banner('Performing PUBLISH test')
-    student_tx_publish(peer)
-    soln_rx_publish(reg, correct_files)
+    yield together((student_tx_publish(peer), peer), (soln_rx_publish(reg, correct_files), reg))
 
+@step
+@timed_phase
 def soln_perform_publish(reg, peer, correct_files):
     banner('Performing PUBLISH test')
-    soln_tx_publish(peer)
-    student_rx_publish(reg, correct_files)
+    yield together((soln_tx_publish(peer), peer), (student_rx_publish(reg, correct_files), reg))
 
+@step
+@timed_phase
 def soln_perform_publish_to_soln(reg, peer, correct_files):
-    soln_tx_publish(peer)
+    yield from soln_tx_publish(peer)
     try:
-        soln_rx_publish(reg, correct_files)
+        yield from soln_rx_publish(reg, correct_files)
     except TestingErrorBase as err:
         raise InternalError(err.message)
 
 def student_tx_publish(node):
     try:
-        tx_publish(node)
+        yield from tx_publish(node)
     except AbnormalTerminationError:
         perror('Program unexpectedly closed during PUBLISH test.')
         raise
 
 def soln_tx_publish(node):
     try:
-        tx_publish(node)
+        yield from tx_publish(node)
     except AbnormalTerminationError as ate:
         raise InternalError('Solution unexpectedly closed during PUBLISH.') from ate
 
 def tx_publish(node):
     node.sendline('PUBLISH')
 
-    verify_alive(node)
+    yield alive(node)
 
 def student_rx_publish(node, correct_files):
     try:
-        count, files = rx_publish(node, correct_files)
+        count, files = yield from rx_publish(node, correct_files)
         if None in (count, files):
             raise TestError('Recognizable TEST] PUBLISH statement not printed.')
     # Just pass TestError
@@ -229,7 +828,7 @@ def student_rx_publish(node, correct_files):
 
 def soln_rx_publish(node, correct_files):
     try:
-        count, files = rx_publish(node, correct_files)
+        count, files = yield from rx_publish(node, correct_files)
         if None in (count, files):
             raise TestError('Program did not send recognizable PUBLISH command.')
     # Pass TestError
@@ -245,58 +844,93 @@ def soln_rx_publish(node, correct_files):
         raise InternalError(f'Solution printed non-ASCII characters. {err}') from err
 
 def rx_publish(node, correct_files):
-    done = False
     pub_count = None
     pub_files = None
-    while not done:
-        val = node.expect(
-            [
-                PREFIX + r'\s+PUBLISH\s+(\d+)\s+([^\r]*)\r\n',
-                pexpect.EOF,
-                pexpect.TIMEOUT,
-                PREFIX + r'\s+(\S*)[^\r]*\r\n',
-                ERRFIX + r'\s+([^\r]*)\r\n'
-            ])
-        if val == 0:  # PUBLISH with count and filenames
-            if pub_count is not None:
-                raise DuplicateCommandError()
-            pub_count = int(node.match.group(1))
-            pub_files = node.match.group(2).split()
-            # Verify the file count printed correctly
-            if pub_count != len(pub_files):
-                raise TestError(f'File count ({pub_count}) does not match number of names ({len(pub_files)}).')
-            if pub_count != len(correct_files):
-                raise TestError(f'File count equals {pub_count} instead of {len(correct_files)}.')
-            # Check the filenames are correct
-            if (len(pub_files) != len(correct_files)) \
-                    or (len(set(pub_files) - set(correct_files)) != 0) \
-                    or (len(set(correct_files) - set(pub_files)) != 0):
-
-                msg = 'Incorrect files.\n'
-                msg += f' command files: {", ".join(sorted(pub_files))}\n'
-                msg += f' correct files: {", ".join(sorted(correct_files))}'
-                raise TestError(msg)
-        elif val == 1:  # EOF
-            raise AbnormalTerminationError()
-        elif val == 2:  # TIMEOUT
-            done = True
-        elif val == 3:  # Incorrect command
-            raise InvalidCommandError(" ".join(node.after.split()[1:]))
-        elif val == 4:  # Error
-            raise TestError(node.match.group(1))
-        else:  # Error
-            raise InternalError(f'rx_publish had expect value {val}.')
 
-    verify_alive(node)
+    def publish(args):  # PUBLISH with count and filenames
+        nonlocal pub_count, pub_files
+        if pub_count is not None:
+            raise DuplicateCommandError()
+        pub_count = int(args.group(1))
+        pub_files = args.group(2).split()
+        check_publish(pub_count, pub_files, correct_files)
+
+    yield lines(node, {'PUBLISH': publish})
+
+    yield alive(node)
 
     return pub_count, pub_files
 
+def check_publish(pub_count, pub_files, correct_files):
+    # Verify the file count printed correctly
+    if pub_count != len(pub_files):
+        raise TestError(f'File count ({pub_count}) does not match number of names ({len(pub_files)}).')
+    if pub_count != len(correct_files):
+        raise TestError(f'File count equals {pub_count} instead of {len(correct_files)}.')
+    # Check the filenames are correct
+    if (len(pub_files) != len(correct_files)) \
+            or (len(set(pub_files) - set(correct_files)) != 0) \
+            or (len(set(correct_files) - set(pub_files)) != 0):
+
+        msg = 'Incorrect files.\n'
+        msg += f' command files: {", ".join(sorted(pub_files))}\n'
+        msg += f' correct files: {", ".join(sorted(correct_files))}'
+        raise TestError(msg)
+
 ################### SEARCH functions ###################################
 
+@step
+@reusable
+@timed_phase
 def student_perform_search(reg, peer, fname, indexed):
     banner(f'Performing SEARCH test for file "{fname}"')
-    rx_id, rx_ip, rx_port = student_tx_search(peer, fname)
-    rx_fname, correct_id, correct_ip, correct_port = soln_rx_search(reg)
+    search_marks.clear()
+    (rx_id, rx_ip, rx_port), (rx_fname, correct_id, correct_ip, correct_port) = \
+        yield together((student_tx_search(peer, fname), peer), (soln_rx_search(reg), reg))
+    record_search_latency()
+
+    check_search(fname, indexed, (rx_fname, rx_id, rx_ip, rx_port), (correct_id, correct_ip, correct_port),
+                 split=responses_split(reg))
+
+@step
+@reusable
+@timed_phase
+def student_perform_search_batch(reg, peer, queries):
+    # queries are (filename, indexed) pairs, sent SEARCH_WINDOW at a time
+    # without waiting for each response
+    banner(f'Performing SEARCH test batch of {len(queries)} files')
+
+    # Registry output is read between windows so its buffers never fill
+    records = []
+    responses = yield from student_tx_search_batch(peer, [fname for fname, _ in queries],
+                                                   lambda: soln_rx_search_batch(reg, records, timeout=0))
+    yield from soln_rx_search_batch(reg, records)
+    if len(records) > len(queries):
+        perror('Multiple SEARCH commands sent.')
+        raise DuplicateCommandError()
+
+    for i, (fname, indexed) in enumerate(queries):
+        try:
+            if responses[i] is None:
+                raise TestError('Recognizable SEARCH response not printed.')
+            if i >= len(records):
+                raise TestError('Recognizable SEARCH command not sent.')
+            rx_fname, correct_id, correct_ip, correct_port = records[i]
+            check_search(fname, indexed, (rx_fname,) + responses[i], (correct_id, correct_ip, correct_port),
+                         split=responses_split(reg))
+        except TestError as err:
+            raise TestError(f'SEARCH {i + 1} of {len(queries)} for file "{fname}": {err.message}') from err
+
+def responses_split(reg):
+    # True if reg is a wire proxy that forwards SEARCH responses in two writes
+    return isinstance(reg, wire_proxy.WireNode) and reg.proxy.split_responses
+
+def check_search(fname, indexed, rx, correct, split=False):
+    # rx is the filename sent to the registry with the result printed by
+    # the program, correct is the result printed by the registry. split is
+    # True if the response reached the peer in two writes.
+    rx_fname, rx_id, rx_ip, rx_port = rx
+    correct_id, correct_ip, correct_port = correct
 
     if (rx_fname, rx_id, rx_ip, rx_port) != (fname, correct_id, correct_ip, correct_port):
         msg = 'SEARCH test had these errors:'
@@ -318,16 +952,26 @@ def student_perform_search(reg, peer, fname, indexed):
                 msg += f'\n IP {rx_ip} printed instead of {correct_ip}.'
             if rx_port != correct_port:
                 msg += f'\n Port {rx_port} printed instead of {correct_port}.'
+
+        # Only the peer ID arrives in the first write, so a correct ID with
+        # a wrong address means the rest of the response was never read
+        if split and rx_id == correct_id and (rx_ip, rx_port) != (correct_ip, correct_port):
+            msg += (f'\n (WIRE) The response was sent in two writes, and the peer read it before all '
+                    f'{protocol.SEARCH_RESPONSE_SIZE} bytes arrived (unchecked recv).')
         raise TestError(msg)
 
     elif indexed and rx_id == 0:
         msg = 'Client incorrectly states file not indexed at any peer.'
         raise TestError(msg)
 
+@step
+@timed_phase
 def soln_perform_search(reg, peer, fname, correct_id, correct_ip, correct_port):
     banner(f'Performing SEARCH test for file "{fname}"')
-    resp_id, resp_ip, resp_port = soln_tx_search(peer, fname)
-    rx_fname, rx_id, rx_ip, rx_port = student_rx_search(reg)
+    search_marks.clear()
+    (resp_id, resp_ip, resp_port), (rx_fname, rx_id, rx_ip, rx_port) = \
+        yield together((soln_tx_search(peer, fname), peer), (student_rx_search(reg), reg))
+    record_search_latency()
 
     # Check the request info printed at the registry
     if (rx_fname, rx_id, rx_ip, rx_port) != (fname, correct_id, correct_ip, correct_port):
@@ -376,7 +1020,7 @@ def soln_perform_search(reg, peer, fname, correct_id, correct_ip, correct_port):
 
 def student_tx_search(node, fname):
     try:
-        peer_id, ip, port = tx_search(node, fname)
+        peer_id, ip, port = yield from tx_search(node, fname)
 
         if None in (peer_id, ip, port):
             raise TestError('Recognizable SEARCH response not printed.')
@@ -394,10 +1038,10 @@ def student_tx_search(node, fname):
 
 def soln_tx_search(node, fname):
     try:
-        peer_id, ip, port = tx_search(node, fname)
+        peer_id, ip, port = yield from tx_search(node, fname)
 
         if None in (peer_id, ip, port):
-            raise TestError('Reconizable SEARCH response not sent by program.')
+            raise TestError('Recognizable SEARCH response not sent by program.')
     except AbnormalTerminationError as ate:
         raise InternalError('Solution unexpectedly closed during SEARCH test.') from ate
     except DuplicateCommandError as dce:
@@ -411,39 +1055,22 @@ def soln_tx_search(node, fname):
 
 def tx_search(node, fname):
     node.sendline('SEARCH')
-    enter_filename(node, fname)
+    yield from enter_filename(node, fname)
+    mark('sent')
 
     done = False
     peer_id = None
     ip = None
     port = None
     while not done:
-        val = node.expect(
-            [
-                # PREFIX not printed to "user"
-                r'[^\d]*(\d+)[^\d]+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s*:\s*(\d+)[^\r]*\r\n',
-                r'.*[Nn]ot\s*[Ii]ndex[^\r]*\r\n',
-                r'.*[Nn]ot\s*[Ff]ound[^\r]*\r\n',
-                pexpect.EOF,
-                pexpect.TIMEOUT
-            ], timeout=2)
-        if val == 0:  # Id and address printed
+        val = yield expect(node, SEARCH_RESPONSE_PATTERNS, step_timeout(peer_id is not None, 2))
+        if val in (0, 1, 2):
+            note_output()
+            if 'response' not in search_marks:
+                mark('response', arrival(node))
             if peer_id is not None:
                 raise DuplicateCommandError()
-            peer_id = int(node.match.group(1))
-            ip = node.match.group(2)
-            port = int(node.match.group(3))
-
-            # Check if program printed all 0s
-            if peer_id == 0 and ip == '0.0.0.0' and port == 0:
-                raise TestError('Search response for unindexed file printed as an indexed file. State the file was not found or not indexed.')
-
-        elif val in (1, 2):  # Not indexed
-            if peer_id is not None:
-                raise DuplicateCommandError()
-            peer_id = 0
-            ip = '0.0.0.0'
-            port = 0
+            peer_id, ip, port = parse_search_response(val, node.match)
         elif val == 3:  # EOF
             raise AbnormalTerminationError()
         elif val == 4:  # TIMEOUT
@@ -451,16 +1078,131 @@ def tx_search(node, fname):
         else:  # Error
             raise InternalError(f'tx_search had expect value {val}.')
 
-    verify_alive(node)
+    yield alive(node)
 
     return peer_id, ip, port
 
+def parse_search_response(val, match):
+    # Peer ID, IP, and port of a response matched by SEARCH_RESPONSE_PATTERNS
+    if val == 0:  # Id and address printed
+        response = (int(match.group(1)), match.group(2), int(match.group(3)))
+
+        # Check if program printed all 0s
+        if response == (0, '0.0.0.0', 0):
+            raise TestError('Search response for unindexed file printed as an indexed file. State the file was not found or not indexed.')
+        return response
+
+    # Not indexed
+    return (0, '0.0.0.0', 0)
+
+def student_tx_search_batch(node, fnames, between):
+    try:
+        responses = yield from tx_search_batch(node, fnames, between)
+    except AbnormalTerminationError:
+        perror('Program unexpectedly closed during SEARCH test.')
+        raise
+    except DuplicateCommandError:
+        perror('Multiple SEARCH responses printed.')
+        raise
+    except UnicodeDecodeError as err:
+        perror(f'Program printed non-ASCII characters. {err}')
+        raise EndTestsException() from err
+
+    return responses
+
+def tx_search_batch(node, fnames, between):
+    # Queries are sent a window at a time and the test between() is run
+    # after each window but the last. The output after each filename
+    # prompt, up to the next prompt, is the response to that query, checked
+    # as tx_search would.
+    text = take(node)
+    prompts = []
+    for start in range(0, len(fnames), SEARCH_WINDOW):
+        window = fnames[start:start + SEARCH_WINDOW]
+        node.send(''.join(f'SEARCH{node.linesep}{fname}{node.linesep}' for fname in window))
+
+        # Only the last window waits to catch output after the responses,
+        # earlier output is checked once the next prompt arrives
+        last = start + len(window) == len(fnames)
+        text, complete = yield from read_search_output(node, text, prompts, start + len(window), last)
+        if not complete:
+            break
+        if not last:
+            yield from between()
+
+    if len(prompts) == 0:
+        msg = 'Missing or unrecognized filename prompt.\nEnsure you use [Ff]ilename and \':\''
+        raise TestError(msg)
+    note_output()
+
+    responses = []
+    ends = [begin for begin, _ in prompts[1:]] + [len(text)]
+    for (_, prompt_end), end in zip(prompts, ends):
+        found = search_responses(text[prompt_end:end])
+        if len(found) > 1:
+            raise DuplicateCommandError()
+        if len(found) == 0:
+            responses.append(None)
+            continue
+
+        val, response = found[0]
+        # Check if program printed all 0s
+        if val == 0 and response == (0, '0.0.0.0', 0):
+            raise TestError('Search response for unindexed file printed as an indexed file. State the file was not found or not indexed.')
+        responses.append(response)
+
+    if len(prompts) < len(fnames):
+        # A program waiting on a missing response prints no more prompts
+        if responses[-1] is not None:
+            msg = 'Missing or unrecognized filename prompt.\nEnsure you use [Ff]ilename and \':\''
+            raise TestError(msg)
+        responses += [None] * (len(fnames) - len(prompts))
+
+    yield alive(node)
+
+    return responses
+
+def read_search_output(node, text, prompts, count, wait):
+    # Reads until count filename prompts and a response after the last have
+    # arrived, then until output stops if wait is set. New prompt spans are
+    # added to prompts.
+    while True:
+        scan = prompts[-1][1] if prompts else 0
+        prompts += [m.span() for m in FILENAME_PROMPT_PATTERNS[0].finditer(text, scan)]
+        complete = len(prompts) >= count and len(search_responses(text[prompts[-1][1]:])) > 0
+        if complete and not wait:
+            return text, complete
+        try:
+            more = yield read(node, step_timeout(complete, 2))
+        except pexpect.EOF as eof:
+            raise AbnormalTerminationError() from eof
+        if not more:  # TIMEOUT
+            return text, complete
+        text += more
+
+def search_responses(text):
+    # Each response in text as (pattern index, response), found in order
+    # like repeated expect calls
+    found = []
+    pos = 0
+    while True:
+        matches = [(m.start(), i, m) for i, p in enumerate(SEARCH_RESPONSE_PATTERNS[:3])
+                   if (m := p.search(text, pos)) is not None]
+        if len(matches) == 0:
+            return found
+        _, val, match = min(matches, key=lambda m: m[:2])
+        if val == 0:  # Id and address printed
+            found.append((val, (int(match.group(1)), match.group(2), int(match.group(3)))))
+        else:  # Not indexed, printed as all zeros by the registry
+            found.append((val, (0, '0.0.0.0', 0)))
+        pos = match.end()
+
 def student_rx_search(node):
     try:
-        fname, rx_id, ip, port = rx_search(node)
+        fname, rx_id, ip, port = yield from rx_search(node)
 
         if None in (fname, rx_id, ip, port):
-            raise TestError('Reconizable SEARCH command not printed.')
+            raise TestError('Recognizable SEARCH command not printed.')
 
     except DuplicateCommandError:
         perror('Multiple SEARCH responses printed.')
@@ -479,10 +1221,10 @@ def student_rx_search(node):
 
 def soln_rx_search(node):
     try:
-        fname, rx_id, ip, port = rx_search(node)
+        fname, rx_id, ip, port = yield from rx_search(node)
 
         if None in (fname, rx_id, ip, port):
-            raise TestError('Reconizable SEARCH command not sent.')
+            raise TestError('Recognizable SEARCH command not sent.')
 
     except DuplicateCommandError:
         perror('Multiple SEARCH commands sent.')
@@ -498,58 +1240,64 @@ def soln_rx_search(node):
 
     return fname, rx_id, ip, port
 
+def soln_rx_search_batch(node, records, timeout=-1):
+    try:
+        yield from rx_search_batch(node, records, timeout)
+    except AbnormalTerminationError as ate:
+        raise InternalError('Solution unexpectedly closed during SEARCH test.') from ate
+    except InvalidCommandError as err:
+        perror(f'Incorrect command sent: "{err.message}"')
+        raise
+    except UnicodeDecodeError as err:
+        perror(f'Filename with non-ASCII characters sent in SEARCH command. {err}')
+        raise EndTestsException() from err
+
+def rx_search_batch(node, records, timeout=-1):
+    # Adds each SEARCH printed to records
+
+    def search(args):  # SEARCH with arguments
+        records.append((args.group(1), int(args.group(2)), args.group(3), int(args.group(4))))
+
+    yield lines(node, {'SEARCH': search}, timeout)
+
+    yield alive(node)
+
 def rx_search(node):
-    done = False
     fname = None
     rx_id = None
     ip = None
     port = None
-    while not done:
-        val = node.expect(
-            [
-                PREFIX + r'\s+SEARCH\s+(\S+)\s+(\d+)\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}):(\d+)[^\r]*\r\n',
-                pexpect.EOF,
-                pexpect.TIMEOUT,
-                PREFIX + r'\s+(\S*)[^\r]*\r\n',
-                ERRFIX + r'\s+([^\r]*)\r\n'
-            ])
-        if val == 0:  # SEARCH with arguments
-            if rx_id is not None:
-                raise DuplicateCommandError()
-            fname = node.match.group(1)
-            rx_id = int(node.match.group(2))
-            ip = node.match.group(3)
-            port = int(node.match.group(4))
-        elif val == 1:  # EOF
-            raise AbnormalTerminationError()
-        elif val == 2:  # TIMEOUT
-            done = True
-        elif val == 3:  # Incorrect command
-            raise InvalidCommandError(" ".join(node.after.split()[1:]))
-        elif val == 4:  # Error
-            raise TestError(node.match.group(1))
-        else:  # Error
-            raise InternalError(f'rx_search had expect value {val}.')
 
-    verify_alive(node)
+    def search(args):  # SEARCH with arguments
+        nonlocal fname, rx_id, ip, port
+        if rx_id is not None:
+            raise DuplicateCommandError()
+        mark('registry', arrival(node))
+        fname = args.group(1)
+        rx_id = int(args.group(2))
+        ip = args.group(3)
+        port = int(args.group(4))
+
+    yield lines(node, {'SEARCH': search})
+
+    yield alive(node)
 
     return fname, rx_id, ip, port
 
 def enter_filename(node, fname):
-    val = node.expect(
-        [
-            r'(?i)[^\r]*[Ff]ile\s*name[^:]*:',
-            pexpect.EOF,
-            pexpect.TIMEOUT
-        ], timeout=1)
+    # Returns the time the filename was sent
+    val = yield expect(node, FILENAME_PROMPT_PATTERNS, 1)
     if val == 1:
         raise AbnormalTerminationError()
     if val == 2:  # Timeout, do nothing if prompt appeared
         msg = 'Missing or unrecognized filename prompt.\nEnsure you use [Ff]ilename and \':\''
         raise TestError(msg)
     node.sendline(fname)
+    return time.perf_counter()
 
 ################### FETCH functions ###################################
+@step
+@timed_phase
 def student_perform_fetch(reg, peer, remotes, src_path, dst_path):
     fname = os.path.basename(src_path)
     if fname != os.path.basename(dst_path):
@@ -557,10 +1305,16 @@ def student_perform_fetch(reg, peer, remotes, src_path, dst_path):
 
     banner(f'Performing FETCH test for file "{fname}"')
 
-    student_tx_fetch(peer, fname)
+    sent = yield from student_tx_fetch(peer, fname)
+
+    # The download is followed from when the filename is sent, so progress
+    # printed while the registry and remote peer are checked is not missed.
+    # Their output waits in its buffer until the download ends.
+    monitor = DownloadMonitor(fname, dst_path, fetch_size(remotes, src_path), sent)
+    yield from wait_for_download(peer, monitor)
 
     # check SEARCH at registry
-    rx_fname, correct_id, correct_ip, correct_port = soln_rx_search(reg)
+    rx_fname, correct_id, correct_ip, correct_port = yield from soln_rx_search(reg)
     if rx_fname != fname:
         raise TestError(f'Program SEARCHed for file {rx_fname} instead of {fname}.')
 
@@ -573,17 +1327,73 @@ def student_perform_fetch(reg, peer, remotes, src_path, dst_path):
     if remote is None:
         raise InternalError(f'Unable to find peer with ID {correct_id} based on SEARCH output.')
 
-    fetch_fname = soln_rx_fetch(remote, fname)
+    fetch_fname = yield from soln_rx_fetch(remote, fname)
     if fetch_fname != fname:
         raise TestError(f'Program sent FETCH command for file {fetch_fname} instead of {fname}.')
 
-    wait_for_download(peer)
+    return compare_files(src_path, dst_path, synthesized.get(fname))
+
+@step
+@timed_phase
+def student_benchmark_fetch(reg, peer, remotes, src_paths, dst_dir):
+    # Performs a FETCH test for each file and records its throughput. The
+    # transfer time runs from sending the filename until the prompt after
+    # the download, so the prompts before it and harness waits at the
+    # registry and remote peer are not included.
+    results = []
+    for src_path in src_paths:
+        fname = os.path.basename(src_path)
+        dst_path = os.path.join(dst_dir, fname)
+        digest = yield from student_perform_fetch.test(reg, peer, remotes, src_path, dst_path)
+        monitor = downloads[-1]
+        elapsed = max(monitor.end - monitor.start, 1e-9)
+        size = os.path.getsize(dst_path)
+        results.append({
+            'file': fname,
+            'bytes': size,
+            'seconds': elapsed,
+            'mb_per_s': size / elapsed / 1e6,
+            'blake2b': digest,
+        })
+
+    banner('FETCH benchmark results')
+    stats.print_table(['file', 'bytes', 'seconds', 'MB/s'],
+                      [[r['file'], r['bytes'], f'{r["seconds"]:.3f}', f'{r["mb_per_s"]:.1f}'] for r in results])
+
+    return results
+
+def fetch_size(remotes, src_path):
+    # Size of src_path at the first remote peer sharing it, 0 if none do
+    for remote in remotes:
+        path = os.path.join(remote[4], src_path)
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+    return 0
+
+def parse_size(text):
+    # Byte count with an optional K, M, or G (powers of 1024) suffix
+    units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    match = re.fullmatch(r'(\d+)([KMG]?)B?', text.strip().upper())
+    if match is None:
+        raise ValueError(f'Invalid size "{text}"')
+    return int(match.group(1)) * units[match.group(2)]
+
+def benchmark_files(sizes):
+    # Creates a sparse synthetic file in the current directory for each
+    # size, returns the filenames. Downloads of them are compared with their
+    # regenerated contents.
+    files = []
+    for size in sizes:
+        fname = f'bench_{size}'
+        synthesized[fname] = synthetic.SyntheticFile(random.getrandbits(64), size)
+        synthesized[fname].write(fname)
+        files.append(fname)
 
-    compare_files(src_path, dst_path)
+    return files
 
 def student_tx_fetch(node, fname):
     try:
-        tx_fetch(node, fname)
+        return (yield from tx_fetch(node, fname))
     except AbnormalTerminationError:
         perror(f'Program unexpectedly closed during FETCH test.')
         raise
@@ -597,19 +1407,21 @@ def soln_tx_fetch(node):
 def tx_fetch(node, fname):
 
     node.sendline('FETCH')
-    enter_filename(node, fname)
+    sent = yield from enter_filename(node, fname)
 
-    verify_alive(node)
+    yield alive(node)
+
+    return sent
 
 def student_rx_fetch(node):
     raise InternalError('student_rx_fetch not implemented')
 
 def soln_rx_fetch(node, fname):
     try:
-        fetch_fname = rx_fetch(node)
+        fetch_fname = yield from rx_fetch(node)
 
         if fetch_fname is None:
-            raise TestError('Recongnizable FETCH command not sent.')
+            raise TestError('Recognizable FETCH command not sent.')
         if fetch_fname != fname:
             raise TestError(f'FETCH request for {fetch_fname} instead of {fname}.')
 
@@ -628,75 +1440,280 @@ def soln_rx_fetch(node, fname):
     return fname
 
 def rx_fetch(node):
-    done = False
     fname = None
-    while not done:
-        val = node.expect([
-            PREFIX+r'\s+FETCH\s+([^\r]+)\r\n',
-            pexpect.EOF,
-            pexpect.TIMEOUT,
-            PREFIX+r'\s+(\S*)[^\r]*\r\n',
-            ERRFIX+r'\s+([^\r]*)\r\n'
-            ], timeout=2)
-        if val == 0: # FETCH with argument
-            if fname is not None:
-                raise DuplicateCommandError()
-            fname = node.match.group(1)
-        elif val == 1: # EOF
-            raise AbnormalTerminationError()
-        elif val == 2: # TIMEOUT
-            done = True
-        elif val == 3: # Incorrect command
-            raise InvalidCommandError(" ".join(node.after.split()[1:]))
-        elif val == 4: # Error
-            raise TestError(node.match.group(1))
-        else: # Error
-            raise InternalError(f'rx_fetch had expect value {val}.')
 
-    verify_alive(node)
+    def fetch(args): # FETCH with argument
+        nonlocal fname
+        if fname is not None:
+            raise DuplicateCommandError()
+        fname = args.group(1)
+
+    yield lines(node, {'FETCH': fetch}, 2)
+
+    yield alive(node)
 
     return fname
 
-def compare_files(server_path, client_path):
+def compare_files(server_path, client_path, expected=None):
+    # The server contents are regenerated from expected, a SyntheticFile,
+    # instead of read from server_path when it is given
+    server = server_path if expected is None else expected
+
     # Exists
-    if (not os.path.isfile(server_path)) or (not os.access(server_path, os.R_OK)):
+    if expected is None and ((not os.path.isfile(server_path)) or (not os.access(server_path, os.R_OK))):
         raise TestError('File does not exist or is not readable at server.')
     if (not os.path.isfile(client_path)) or (not os.access(client_path, os.R_OK)):
         raise TestError('File does not exist or is not readable at client.')
-    # Check file access and equivalence
-    if not filecmp.cmp(server_path, client_path, shallow=False):
-        client_stat = os.lstat(client_path)
-        server_stat = os.lstat(server_path)
-        if client_stat.st_size != server_stat.st_size:
-            raise TestError(f'File at server has size {server_stat.st_size}, while client file has size {client_stat.st_size}')
-        else:
-            raise TestError('Files at server and client have the same size, but different contents.')
 
-def wait_for_download(node):
-    try:
-        # Wait for transfer to complete
-        val = node.expect([pexpect.TIMEOUT, r'[^:]*:'],
-                timeout=DOWNLOAD_TIMEOUT) # Transfer may take a long time
-        if val == 0: # TIMEOUT
-            raise TestError('Download took too long or program produced an unrecognizable prompt.')
-        elif val == 1: # Prompt, do nothing
-            pass
-        else: # ERROR
-            raise InternalError(f'wait_for_prompt had expect value {val}.')
+    # Compare both files in a single streaming pass, stopping at the first
+    # difference. Returns a digest of the contents for reports.
+    server_size = os.path.getsize(server_path) if expected is None else expected.size
+    client_size = os.path.getsize(client_path)
+    digest = hashlib.blake2b()
+    server_buf = bytearray(COMPARE_CHUNK_SIZE)
+    client_buf = bytearray(COMPARE_CHUNK_SIZE)
+    offset = 0
+    with open_contents(server) as server_file, open(client_path, 'rb', buffering=0) as client:
+        while True:
+            n = read_chunk(server_file, server_buf)
+            m = read_chunk(client, client_buf)
+            # Bytes past a short final chunk are left from the previous chunk,
+            # which matched, so whole buffers can be compared without copies
+            if n != m or server_buf != client_buf:
+                diff = offset + first_difference(server_buf, client_buf, min(n, m))
+                raise TestError(mismatch_message(server, client_path, server_size, client_size, diff))
+            if n == 0:
+                break
+            digest.update(memoryview(server_buf)[:n])
+            offset += n
+
+    return digest.hexdigest()
+
+def open_contents(source):
+    # Unbuffered reader of a path or a SyntheticFile
+    if isinstance(source, synthetic.SyntheticFile):
+        return source.reader()
+    return open(source, 'rb', buffering=0)
+
+def read_at(source, length, offset):
+    # Up to length bytes at offset of a path or a SyntheticFile
+    if isinstance(source, synthetic.SyntheticFile):
+        return source.pread(length, offset)
+    with open(source, 'rb') as f:
+        return os.pread(f.fileno(), length, offset)
+
+def read_chunk(f, buf):
+    # Fill buf unless end of file is reached, returns the number of bytes read
+    view = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        n = f.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+def first_difference(a, b, length):
+    # Offset of the first differing byte in the first length bytes, length if
+    # they are equal. Blocks are compared first to avoid a byte by byte scan.
+    block = 4096
+    for start in range(0, length, block):
+        end = min(start + block, length)
+        if a[start:end] != b[start:end]:
+            for i in range(start, end):
+                if a[i] != b[i]:
+                    return i
+    return length
+
+def mismatch_message(server, client_path, server_size, client_size, offset):
+    if server_size != client_size:
+        msg = f'File at server has size {server_size}, while client file has size {client_size}'
+    else:
+        msg = 'Files at server and client have the same size, but different contents.'
+    msg += f'\n First difference at byte {offset} (0x{offset:x}).'
+
+    # Aligned window of bytes around the difference from both files
+    start = max(0, offset - HEXDUMP_CONTEXT) // 16 * 16
+    length = offset - start + HEXDUMP_CONTEXT
+    for label, source in (('server', server), ('client', client_path)):
+        data = read_at(source, length, start)
+        msg += f'\n {label}:'
+        msg += hexdump(data, start, offset)
+
+    return msg
+
+def hexdump(data, start, mark):
+    # Rows of 16 bytes, the byte at offset mark is bracketed
+    rows = ''
+    if len(data) == 0:
+        return '\n  (end of file)'
+    for row in range(0, len(data), 16):
+        chunk = data[row:row + 16]
+        cells = []
+        for i, byte in enumerate(chunk):
+            cell = f'{byte:02x}'
+            cells.append(f'[{cell}]' if start + row + i == mark else f' {cell} ')
+        text = ''.join(chr(c) if 32 <= c < 127 else '.' for c in chunk)
+        rows += f'\n  {start + row:08x} {"".join(cells):<64} |{text}|'
+    if start + len(data) <= mark:
+        rows += '\n  (end of file)'
+    return rows
+
+class DownloadMonitor:
+    '''Follows the output of a peer during a FETCH until its next prompt.
+    Only output not yet examined is scanned, and at most DOWNLOAD_WINDOW
+    characters of an unfinished line are kept. Printed progress becomes
+    (seconds, bytes, bytes per second) samples, at most one per
+    DOWNLOAD_SAMPLE_INTERVAL.'''
+
+    def __init__(self, fname, dst_path, size, start=None):
+        self.fname = fname
+        self.dst_path = dst_path
+        self.size = size
+        self.start = time.perf_counter() if start is None else start
+        self.active = self.start  # Last output or growth of the download
+        self.partial = ''
+        self.received = 0
+        self.on_disk = 0
+        self.samples = []
+        self.end = None
+
+    def feed(self, text):
+        # Returns the output after a prompt line once it is found, otherwise
+        # None
+        if len(text) > 0:
+            self.active = time.perf_counter()
+        text = self.partial + text
+        pos = 0
+        for end in LINE_END_RE.finditer(text):
+            line = text[pos:end.start()]
+            pos = end.end()
+            if self.is_prompt(line):
+                return text[pos:]
+        self.partial = text[pos:][-DOWNLOAD_WINDOW:]
+        if self.waiting() and parse_progress(self.partial, self.size) is None:
+            # Prompts are printed without a line ending
+            self.partial = ''
+            return ''
+        return None
+
+    def waiting(self):
+        # Once output stops, an unfinished line ending in a colon is a
+        # prompt waiting for input
+        return self.partial.rstrip().endswith(':')
+
+    def is_prompt(self, line):
+        # Like the old '[^:]*:' match, any line with a colon that is not
+        # progress. A line ending in a colon is a prompt even when it
+        # reports progress.
+        if line.rstrip().endswith(':'):
+            return True
+        received = parse_progress(line, self.size)
+        if received is None:
+            return ':' in line
+        self.progress(received)
+        return False
+
+    def progress(self, received):
+        now = time.perf_counter()
+        last = self.samples[-1] if self.samples else (0.0, 0, 0.0)
+        elapsed = now - self.start
+        if received > self.received:
+            self.active = now
+        self.received = received
+        if elapsed - last[0] >= DOWNLOAD_SAMPLE_INTERVAL:
+            rate = (received - last[1]) / (elapsed - last[0])
+            self.samples.append((elapsed, received, rate))
+
+    def poll(self):
+        # Growth of the downloaded file counts as progress for peers that
+        # print none
+        try:
+            size = os.stat(self.dst_path).st_size
+        except OSError:
+            return
+        if size > self.on_disk:
+            self.on_disk = size
+            self.active = time.perf_counter()
+
+    def describe(self):
+        received = max(self.received, self.on_disk)
+        msg = f'{received} of {self.size} bytes'
+        if self.samples:
+            rate = self.samples[-1][2]
+            msg += f', last at {rate / 1e6:.1f} MB/s' if rate >= 1e6 else f', last at {rate / 1e3:.1f} KB/s'
+        return msg
 
+    def to_dict(self):
+        return {
+            'file': self.fname,
+            'bytes': self.size,
+            'seconds': (self.end or time.perf_counter()) - self.start,
+            'samples': [{'seconds': t, 'bytes': b, 'bytes_per_second': r} for t, b, r in self.samples],
+        }
+
+def parse_progress(line, total):
+    # Bytes received printed in line, None if it is not progress
+    match = PROGRESS_PATTERNS[0].search(line)
+    if match is not None:  # Received and total
+        return int(match.group(1))
+    match = PROGRESS_PATTERNS[1].search(line)
+    if match is None:
+        return None
+    value = float(match.group(1))
+    unit = match.group(2).upper()
+    if unit == '%':
+        return int(total * value / 100)
+    if unit == 'BYTES':
+        unit = 'B'
+    return int(value * parse_size('1' + unit[0]))
+
+def wait_for_download(node, monitor):
+    # Waits for the prompt after the download followed by monitor, with
+    # DOWNLOAD_TIMEOUT as the limit for the whole transfer and
+    # DOWNLOAD_STALL_TIMEOUT as the limit without output or progress
+    downloads.append(monitor)
+    deadline = monitor.start + DOWNLOAD_TIMEOUT
+    try:
+        rest = monitor.feed(take(node))
+        while rest is None:
+            monitor.poll()
+            now = time.perf_counter()
+            if now - monitor.active >= DOWNLOAD_STALL_TIMEOUT:
+                raise TestError(f'Download stalled, no output or progress for {DOWNLOAD_STALL_TIMEOUT} seconds'
+                                f' after {monitor.describe()}.')
+            if now >= deadline:
+                raise TestError(f'Download took too long or program produced an unrecognizable prompt'
+                                f' ({monitor.describe()}).')
+            wait = min(DOWNLOAD_SAMPLE_INTERVAL, deadline - now, monitor.active + DOWNLOAD_STALL_TIMEOUT - now)
+            text = yield read(node, max(0, wait))
+            if text:
+                rest = monitor.feed(text)
+            elif monitor.waiting():  # TIMEOUT
+                rest = ''
+        note_output()
+        unread(node, rest)
+
+    except pexpect.EOF as eof:
+        perror('Program unexpectedly closed during FETCH test.')
+        raise AbnormalTerminationError() from eof
     except UnicodeDecodeError as err:
         perror(f'Program printed non-ASCII characters. {err}')
         raise EndTestsException() from err
+    finally:
+        monitor.end = time.perf_counter()
 
-    verify_alive(node)
+    yield alive(node)
 
 ################### REGISTER functions ###################################
 
+@step
+@timed_phase
 def soln_perform_register(reg, peer, soln_id):
-    tx_ip, tx_port = soln_tx_register(peer)
+    tx_ip, tx_port = yield from soln_tx_register(peer)
     if tx_ip is None:
         raise InternalError('Solution peer did not print a recognizable ADDR response.')
-    peer_id, ip, port = soln_rx_register(reg)
+    peer_id, ip, port = yield from soln_rx_register(reg)
     if soln_id != peer_id:
         raise InternalError(f'Solution peer REGISTERed id {peer_id} instead of {soln_id}.')
     if (tx_ip, tx_port) != (ip, port):
@@ -706,7 +1723,7 @@ def soln_perform_register(reg, peer, soln_id):
 
 def soln_tx_register(node):
     try:
-        return tx_register(node)
+        return (yield from tx_register(node))
     except AbnormalTerminationError as ate:
         raise InternalError('Solution peer unexpectedly closed during REGISTER.') from ate
     except DuplicateCommandError as err:
@@ -719,40 +1736,25 @@ def soln_tx_register(node):
 def tx_register(node):
     node.sendline('REGISTER')
 
-    done = False
     ip = None
     port = None
-    while not done:
-        val = node.expect([
-            PREFIX+r'\s+ADDR\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s*:\s*(\d+)[^\r]*\r\n',
-            pexpect.EOF,
-            pexpect.TIMEOUT,
-            PREFIX+r'\s+(\S*)[^\r]*\r\n',
-            ERRFIX+r'\s+([^\r]*)\r\n'
-            ], timeout=2)
-        if val == 0: # Address printed
-            if ip is not None:
-                raise DuplicateCommandError()
-            ip = node.match.group(1)
-            port = int(node.match.group(2))
-        elif val == 1: # EOF
-            raise AbnormalTerminationError()
-        elif val == 2: # TIMEOUT
-            done = True
-        elif val == 3: # Incorrect command
-            raise InvalidCommandError(" ".join(node.after.split()[1:]))
-        elif val == 4: # Error
-            raise TestError(node.match.group(1))
-        else: # Error
-            raise InternalError(f'tx_register had expect value {val}.')
 
-    verify_alive(node)
+    def addr(args): # Address printed
+        nonlocal ip, port
+        if ip is not None:
+            raise DuplicateCommandError()
+        ip = args.group(1)
+        port = int(args.group(2))
+
+    yield lines(node, {'ADDR': addr}, 2)
+
+    yield alive(node)
 
     return ip, port
 
 def soln_rx_register(node):
     try:
-        peer_id, ip, port = rx_register(node)
+        peer_id, ip, port = yield from rx_register(node)
         if None in (peer_id, ip, port):
             raise TestError('Peer did not send recognizable REGISTER request.')
     except DuplicateCommandError as err:
@@ -768,56 +1770,44 @@ def soln_rx_register(node):
     return peer_id, ip, port
 
 def rx_register(node):
-    done = False
     peer_id = None
     ip = None
     port = None
-    while not done:
-        val = node.expect([
-            PREFIX+r'\s+REGISTER\s+(\d+)\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s*:\s*(\d+)[^\r]*\r\n',
-            pexpect.EOF,
-            pexpect.TIMEOUT,
-            PREFIX+r'\s+(\S*)[^\r]*\r\n',
-            ERRFIX+r'\s+([^\r]*)\r\n'
-            ], timeout=2)
-        if val == 0: # Id and address printed
-            if peer_id is not None:
-                raise DuplicateCommandError()
-            peer_id = int(node.match.group(1))
-            ip = node.match.group(2)
-            port = int(node.match.group(3))
-        elif val == 1: # EOF
-            raise AbnormalTerminationError()
-        elif val == 2: # TIMEOUT
-            done = True
-        elif val == 3: # Incorrect command
-            raise InvalidCommandError(" ".join(node.after.split()[1:]))
-        elif val == 4: # Error
-            raise TestError(node.match.group(1))
-        else: # Error
-            raise InternalError(f'rx_register had expect value {val}.')
 
-    verify_alive(node)
+    def register(args): # Id and address printed
+        nonlocal peer_id, ip, port
+        if peer_id is not None:
+            raise DuplicateCommandError()
+        peer_id = int(args.group(1))
+        ip = args.group(2)
+        port = int(args.group(3))
+
+    yield lines(node, {'REGISTER': register}, 2)
+
+    yield alive(node)
 
     return peer_id, ip, port
 
 ################### EXIT functions ###################################
 
+@step
+@timed_phase
 def student_perform_exit(reg, peer):
     banner('Performing EXIT test')
-    student_tx_exit(peer)
-    soln_rx_exit(reg)
+    yield together((student_tx_exit(peer), peer), (soln_rx_exit(reg), reg))
 
+@step
+@timed_phase
 def soln_perform_exit(reg, peer):
-    soln_tx_exit(peer)
+    yield from soln_tx_exit(peer)
     try:
-        soln_rx_exit(reg)
+        yield from soln_rx_exit(reg)
     except TestingErrorBase as err:
         raise InternalError(err.message)
 
 def student_tx_exit(node):
     try:
-        tx_exit(node)
+        yield from tx_exit(node)
     except TestError as err:
         raise TestError('Program failed to close in EXIT test.') from err
     except AbnormalTerminationError as err:
@@ -825,18 +1815,19 @@ def student_tx_exit(node):
 
 def soln_tx_exit(node):
     try:
-        tx_exit(node)
+        yield from tx_exit(node)
     except TestError as err:
         raise InternalError('Solution failed to close in EXIT test.') from err
 
 def tx_exit(node):
+    disarm(node)
     node.sendline('EXIT')
-    verify_dead(node)
+    yield dead(node)
 
 def student_rx_exit(node):
     raise InternalError('student_rx_exit not tested')
     try:
-        rx_exit(node)
+        yield from rx_exit(node)
     except InvalidCommandError as err:
         perror(f'Command printed incorrectly for EXIT command: "{err.message}"')
         raise
@@ -845,7 +1836,7 @@ def student_rx_exit(node):
 
 def soln_rx_exit(node):
     try:
-        rx_exit(node)
+        yield from rx_exit(node)
     except InvalidCommandError as err:
         perror(f'Incorrect command sent: "{err.message}".')
         raise
@@ -853,59 +1844,368 @@ def soln_rx_exit(node):
         raise InternalError('Solution closed during EXIT test.') from ate
 
 def rx_exit(node):
-    done = False
-    while not done:
-        val = node.expect(
-            [
-                PREFIX + r'\s+(\S*)[^\r]*\r\n',
-                pexpect.EOF,
-                pexpect.TIMEOUT,
-                ERRFIX + r'\s+([^\r]*)\r\n'
-            ])
-        if val == 0:  # Incorrect command
-            raise InvalidCommandError(" ".join(node.after.split()[1:]))
-        if val == 1:  # EOF
-            raise AbnormalTerminationError()
-        if val == 2:  # TIMEOUT
-            done = True
-        elif val == 3:  # Error
-            raise TestError(node.match.group(1))
-        else:  # Error
-            raise InternalError(f'rx_exit had expect {val}.')
+    # No output expected, any TEST] line is an incorrect command
+    yield lines(node, {})
+
+    yield alive(node)
+
+################### Line dispatch ###################################
+
+class LineReader:
+    '''Splits the output of a node into lines once as it arrives. Unread
+    output is returned to the node buffer by close() so later expect() calls
+    still see it.'''
+
+    def __init__(self, node):
+        self.node = node
+        self.lines = collections.deque()
+        self.partial = node.buffer
+        node.buffer = ''
+        self.split()
+
+    def split(self):
+        *lines, self.partial = self.partial.split('\r\n')
+        self.lines.extend(lines)
+
+    def readline(self, timeout):
+        # Next line without the line ending, None on timeout, raises
+        # pexpect.EOF once all complete lines are read
+        if timeout == -1:
+            timeout = self.node.timeout
+        end = None if timeout is None else time.monotonic() + timeout
+        while len(self.lines) == 0:
+            remaining = None if end is None else max(0, end - time.monotonic())
+            try:
+                self.partial += self.node.read_nonblocking(self.node.maxread, remaining)
+            except pexpect.TIMEOUT:
+                return None
+            self.split()
+
+        return self.lines.popleft()
+
+    def close(self):
+        self.node.buffer = ''.join(line + '\r\n' for line in self.lines) + self.partial
+
+def dispatch_lines(node, handlers, timeout=-1):
+    # Reads TEST] and ERROR] lines until the step completes, see step_timeout.
+    # TEST] lines with a command keyword in handlers and valid arguments are
+    # passed to the handler as a match of COMMAND_ARGS[keyword]. Other TEST]
+    # lines are incorrect commands. Lines without a prefix are ignored.
+    reader = LineReader(node)
+    matched = len(handlers) == 0  # Nothing expected, only wait for stragglers
+    try:
+        while True:
+            try:
+                line = reader.readline(step_timeout(matched, timeout))
+            except pexpect.EOF as eof:
+                raise AbnormalTerminationError() from eof
+            if line is None:  # TIMEOUT
+                return
+            if dispatch_line(line, handlers):
+                matched = True
+    finally:
+        reader.close()
+
+def dispatch_line(line, handlers):
+    # True if line is a command passed to its handler, see dispatch_lines
+    match = PREFIXES_RE.search(line)
+    if match is None:
+        return False
+    rest = line[match.end():]
+    if match.group() == ERRFIX:  # Error
+        raise TestError(rest.lstrip())
+
+    words = rest.split()
+    keyword = words[0] if len(words) > 0 else ''
+    args = None
+    if keyword in handlers:
+        args = COMMAND_ARGS[keyword].match(rest)
+    if args is None:  # Incorrect command
+        raise InvalidCommandError(' '.join(words))
+    note_output()
+    handlers[keyword](args)
+    return True
+
+################### Concurrent harness functions ###################################
+# The student tests with every node read at once on one event loop, see
+# async_node. The program and registry sides of a step run together, and
+# the first to fail ends the step instead of waiting out the other.
+
+async def run_together_async(*steps):
+    # Results of tests, (test, node) pairs, run at once. Once a test has
+    # read all it needs from its node, the node exiting ends the other tests
+    # like wait_output. Once one raises the others are cancelled, and the
+    # error of the first in argument order that failed is raised.
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(run_async(test)) for test, _ in steps]
+    watchers = []
+    waiting = set(tasks)
+    try:
+        while any(not task.done() for task in tasks):
+            done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if any(task.exception() is not None for task in done):
+                break
+            for (_, node), task in zip(steps, tasks):
+                if task in done and node in watched and watched[node].armed:
+                    watchers.append(asyncio.ensure_future(watch_exit(watched[node])))
+                    waiting.add(watchers[-1])
+    finally:
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        for phase in phase_stack:
+            phase.blocked += elapsed
+    for task in tasks + watchers:
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+    return [task.result() for task in tasks]
+
+async def watch_exit(w):
+    await w.node.wait_exit(None)
+    if w.armed:
+        died(w)
+
+@timed_phase
+async def start_registry_async(exe, port, timeout, do_debug=False):
+    # Solution registry, see start_registry
+    args = [str(port), '-t']
+    if do_debug:
+        args.append('-d')
 
-    verify_alive(node)
+    logfile=None
+    if do_debug:
+        logfile=sys.stdout
+        if use_py_registry:
+            print(f'[INFO] Python registry: {" ".join(args)}')
+        else:
+            print(f'[INFO] Command line: {exe} {" ".join(args)}')
+    if use_py_registry:
+        reg = async_node.attach(py_registry.start(port, timeout, test=True, debug=do_debug), logfile=logfile)
+    else:
+        reg = await async_node.spawn(os.path.join('.', exe), args, timeout=timeout, logfile=logfile)
+    async_nodes.append(reg)
+    capture(reg, 'registry')
+
+    watch(reg, 'Registry unexpectedly quit', True)
+
+    try:
+        await wait_listening_async(reg, port, timeout)
+    except AbnormalTerminationError as ate:
+        raise InternalError('Registry unexpectedly quit.') from ate
+    else:
+        atexit.register(reg.terminate, True)
+
+    return reg
+
+@timed_phase
+async def start_peer_async(exe, host, port, peer_id, wd, files, shared_dir, do_debug=False):
+    # Student peer, see start_peer
+    args = [host, str(port), str(peer_id)]
+    share_files(wd, shared_dir, files)
+    os.rename(exe, os.path.join(wd, exe))
+
+    logfile=None
+    if do_debug:
+        logfile=sys.stdout
+        print(f'[INFO] Command line: {exe} {" ".join(args)}')
+    peer = await async_node.spawn(os.path.join(os.getcwd(), wd, exe), args,
+                                  cwd=os.path.join(os.getcwd(), wd), logfile=logfile)
+    async_nodes.append(peer)
+    capture(peer, f'peer {peer_id}')
+    watch(peer, 'Program unexpectedly closed')
+
+    try:
+        await verify_alive_async(peer)
+    except AbnormalTerminationError as ate:
+        print(peer.buffer)
+        msg = 'Peer unexpectedly closed.'
+        perror(msg)
+        raise AbnormalTerminationError(msg) from ate
+    else:
+        atexit.register(peer.terminate, True)
+
+    return peer
+
+async def dispatch_lines_async(node, handlers, timeout=-1):
+    # dispatch_lines for an AsyncNode
+    matched = len(handlers) == 0
+    while True:
+        try:
+            line = await node.readline(step_timeout(matched, timeout))
+        except pexpect.EOF as eof:
+            raise AbnormalTerminationError() from eof
+        if line is None:  # TIMEOUT
+            return
+        if dispatch_line(line, handlers):
+            matched = True
+
+async def read_output_async(node, timeout):
+    # read_output for an AsyncNode
+    if not node.buffer:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not node.buffer:
+            if not await node.wait(deadline):
+                if node.eof:
+                    raise pexpect.EOF('')
+                return ''
+    return node.take()
+
+async def verify_alive_async(node):
+    # Output already written is collected without waiting
+    val = await node.expect([pexpect.EOF, pexpect.TIMEOUT], timeout=0)
+    if val == 0 or not node.isalive():
+        raise AbnormalTerminationError()
+
+async def verify_dead_async(node):
+    if not await node.wait_exit(EXIT_TIMEOUT):
+        raise TestError()
+    node.close()
+    if node.exitstatus != 0 or node.exitstatus is None:
+        raise AbnormalTerminationError('Non-zero exit status used under normal EXIT.')
+
+async def stop_nodes_async():
+    # Programs still running are killed before the event loop that watches
+    # them closes. Like the atexit teardown of the serial harness, the last
+    # started is stopped first, so peers close their connections before the
+    # registry and its port is not left in TIME_WAIT.
+    for node in reversed(async_nodes):
+        node.terminate(True)
+        await node.wait_exit(EXIT_TIMEOUT)
+    async_nodes.clear()
+
+async def wait_listening_async(node, port, timeout):
+    # wait_listening for an AsyncNode
+    deadline = time.monotonic() + timeout
+    while True:
+        ready = listening(port)
+        if ready is None:
+            ready = not await node.wait_exit(STARTUP_DELAY)
+        if ready or time.monotonic() >= deadline:
+            break
+        if await node.wait_exit(LIVENESS_POLL_INTERVAL):
+            break
+    await verify_alive_async(node)
+
+################### Staging functions ###################################
+# Files are placed in the temporary directory without copying their data
+# when the filesystem allows it
+
+def stage(src, dst, link=False):
+    # Places file src at dst, a path or an existing directory. A reflink
+    # (copy on write) is used first, then a hardlink if link is set because
+    # neither file is written in place, and a copy otherwise. Returns dst.
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if reflink(src, dst):
+        staged['reflink'] += 1
+    elif link and hardlink(src, dst):
+        staged['link'] += 1
+    else:
+        shutil.copy(src, dst)
+        staged['copy'] += 1
+        staged['bytes_copied'] += os.path.getsize(dst)
+    return dst
+
+def stage_tree(src, dst, link=False):
+    shutil.copytree(src, dst, copy_function=functools.partial(stage, link=link))
+
+def reflink(src, dst):
+    # Filesystems without reflinks, or pairs of them, are only tried once
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+    if devices in no_reflink:
+        return False
+    try:
+        # An existing dst, perhaps a hardlink of a source, is never truncated
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError:
+        return False
+    try:
+        with open(src, 'rb') as s:
+            fcntl.ioctl(fd, FICLONE, s.fileno())
+    except OSError as err:
+        if err.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+            no_reflink.add(devices)
+        os.close(fd)
+        os.unlink(dst)
+        return False
+    os.close(fd)
+    shutil.copymode(src, dst)
+    return True
+
+def hardlink(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        return False
+    return True
 
 ################### Generic functions ###################################
 
+def step_timeout(matched, timeout=-1):
+    # Once the expected output has been seen, a step only waits for a short
+    # quiet period to catch duplicate or invalid output instead of the full
+    # timeout. A timeout of -1 uses the node's default timeout.
+    if matched and settle_timeout is not None:
+        return settle_timeout
+    return timeout
+
 def verify_alive(node):
+    # Output already written is collected without waiting
     val = node.expect(
         [
             pexpect.EOF,
             pexpect.TIMEOUT
-        ], timeout=0.2)
-    if val == 0 or not node.isalive():
+        ], timeout=0)
+    if val == 0 or node_exited(node):
         raise AbnormalTerminationError()
 
 def verify_dead(node):
-    val = node.expect(
-        [
-            pexpect.EOF,
-            pexpect.TIMEOUT
-        ], timeout=0.2)
-    if val == 1 and node.isalive():
+    disarm(node)
+    if not node_exited(node, EXIT_TIMEOUT):
         raise TestError()
     node.close()
     if node.exitstatus != 0 or node.exitstatus is None:
         raise AbnormalTerminationError('Non-zero exit status used under normal EXIT.')
 
-def initial_setup(base_files, base_exes, required_exes):
+@timed_phase
+def initial_setup(base_files, base_exes, required_exes, options=None):
+    # options are those of the calling script that change its tests, part
+    # of the result key
     global tmp_dir
 
+    global settle_timeout, use_py_registry, use_build_cache, use_wire_proxy, split_responses, registry_port, \
+        debug_output
+    global check_options
+    check_options = options or {}
+    do_debug, do_keep, settle_timeout, use_py_registry, use_build_cache, use_wire_proxy, split_responses, \
+        report_path, registry_port, seed, result_cache, tmp_root = parse_args()
+    debug_output = do_debug
+
     # Temporary directory name
     # Default name used with keep argument, changed if using tempfile class
-    tmp_dirname = os.path.join(os.getcwd(), 'tmp_local_dir_for_check')
-
-    do_debug, do_keep = parse_args()
+    tmp_dirname = os.path.join(tmp_root or os.getcwd(), 'tmp_local_dir_for_check')
+
+    # Every random choice of the run but the registry port follows from the
+    # seed, so a run is replayed with -s and the seed from its report. Until it passes, the
+    # files of a failed run are checked again with the same seed.
+    seed_path = os.path.join(RESULT_CACHE_DIR, 'seeds', submission_key(sys.argv))
+    if seed is None:
+        seed = load_seed(seed_path)
+        if seed is not None:
+            print(f'Replaying seed {seed} of the last failed run, use -s to choose another seed.')
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    random.seed(seed)
+    run_report['seed'] = seed
+    atexit.register(store_seed, seed_path, seed)
+    if report_path is not None:
+        # Written however the run ends
+        atexit.register(write_report, report_path)
+    if use_wire_proxy and settle_timeout is None:
+        # Messages are complete when they are seen, only wait for duplicates
+        settle_timeout = WIRE_SETTLE_TIMEOUT
 
     script_dir = os.path.dirname(__file__)
 
@@ -994,20 +2294,54 @@ def initial_setup(base_files, base_exes, required_exes):
             print(f'Error creating temporary directory "{os.path.basename(tmp_dirname)}": {err.strerror}')
             sys.exit()
     else:
-        tmp_dir = tempfile.TemporaryDirectory()
+        tmp_dir = tempfile.TemporaryDirectory(dir=tmp_root)
         tmp_dirname = tmp_dir.name
 
-    # Copy the argument files, base_files, and base_exes into the tempdir
-    for f in user_files:
-        shutil.copy(f, tmp_dirname)
-    for f in base_files + base_exes:
+    # Reuse the executables built from identical files by an earlier run
+    build_dir = os.path.join(BUILD_CACHE_DIR, build_key(user_files, base_files, required_exes))
+    if use_build_cache and all(os.access(os.path.join(build_dir, f), os.X_OK) for f in required_exes):
+        # Nothing is built, and the executables are only run, so they are
+        # hardlinked
+        for f in base_exes:
+            stage(f, tmp_dirname, link=True)
+        for f in required_exes:
+            stage(os.path.join(build_dir, f), tmp_dirname, link=True)
+
+        os.chdir(tmp_dirname)
+
+        banner('Using cached executables, files are unchanged since the last successful build')
+
+        load_results(required_exes, base_exes, seed, result_cache)
+
+        return do_debug
+
+    # Copy the argument files, base_files, and base_exes into the tempdir.
+    # The build can write any file it sees, so none are hardlinked.
+    for f in user_files + base_files + base_exes:
         if os.path.isdir(f):
-            shutil.copytree(f, os.path.join(tmp_dirname, os.path.basename(f)))
+            stage_tree(f, os.path.join(tmp_dirname, os.path.basename(f)))
         else:
-            shutil.copy(f, tmp_dirname)
+            stage(f, tmp_dirname)
 
     os.chdir(tmp_dirname)
 
+    build_executables(do_debug)
+
+    required_exes = [os.path.abspath(os.path.join(tmp_dirname, f)) for f in required_exes]
+    for f in required_exes:
+        if (not os.path.isfile(f)) or (not os.access(f, os.X_OK)):
+            print(f'\nExecutable "{os.path.basename(f)}" required, but not created by make or not executable.')
+            sys.exit()
+
+    banner('Compilation successful')
+
+    store_build(build_dir, required_exes)
+
+    load_results(required_exes, base_exes, seed, result_cache)
+
+    return do_debug
+
+def build_executables(do_debug):
     # Compile the executables
     banner("Attempting to build the executables.")
     logfile = None
@@ -1047,16 +2381,50 @@ def initial_setup(base_files, base_exes, required_exes):
         else:
             raise InternalError('Unexpcted return from expect() during make.')
 
-    required_exes = [os.path.abspath(os.path.join(tmp_dirname, f)) for f in required_exes]
-    for f in required_exes:
-        if (not os.path.isfile(f)) or (not os.access(f, os.X_OK)):
-            print(f'\nExecutable "{os.path.basename(f)}" required, but not created by make or not executable.')
-            sys.exit()
-
-    banner('Compilation successful')
-
-    return do_debug
-
+def build_key(user_files, base_files, required_exes):
+    # Hash of everything that affects the build: the user files (sources and
+    # Makefile) and the provided headers and libraries.
+    digest = hashlib.sha256()
+    digest.update('\0'.join(required_exes).encode())
+    for name, path in sorted(build_inputs(user_files + base_files)):
+        digest.update(b'\0' + name.encode() + b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+def build_inputs(files):
+    # (name, path) of every file, directories are expanded recursively
+    for f in files:
+        name = os.path.basename(f)
+        if os.path.isdir(f):
+            for root, dirs, names in os.walk(f, followlinks=True):
+                for n in names:
+                    path = os.path.join(root, n)
+                    yield os.path.join(name, os.path.relpath(path, f)), path
+        else:
+            yield name, f
+
+def store_build(build_dir, exes):
+    # Only builds that passed every compile check are stored. Builds are
+    # written to a private directory and renamed into place so concurrent
+    # runs never see a partial entry.
+    if os.path.isdir(build_dir):
+        return
+    partial = None
+    try:
+        os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+        partial = tempfile.mkdtemp(dir=BUILD_CACHE_DIR, prefix='.partial-')
+        for f in exes:
+            stage(f, partial, link=True)
+        os.rename(partial, build_dir)
+    except OSError:
+        # The cache is an optimization, ignore any problems
+        if partial is not None:
+            shutil.rmtree(partial, ignore_errors=True)
+
+@timed_phase
 def start_registry(exe, port, timeout, soln=True, do_debug=False):
     args = [str(port)]
     if soln:
@@ -1067,16 +2435,27 @@ def start_registry(exe, port, timeout, soln=True, do_debug=False):
     logfile=None
     if do_debug:
         logfile=sys.stdout
-        print(f'[INFO] Command line: {exe} {" ".join(args)}')
-    reg = pexpect.spawn(os.path.join('.', exe),
-                        args,
-                        timeout=timeout,
-                        encoding='utf-8',
-                        logfile=logfile)
+        if use_py_registry:
+            print(f'[INFO] Python registry: {" ".join(args)}')
+        else:
+            print(f'[INFO] Command line: {exe} {" ".join(args)}')
+    if use_py_registry:
+        # Stand-in registry served from this process, only used as a solution
+        reg = py_registry.start(port, timeout, test=soln, debug=soln and do_debug, logfile=logfile)
+    else:
+        reg = pexpect.spawn(os.path.join('.', exe),
+                            args,
+                            timeout=timeout,
+                            encoding='utf-8',
+                            logfile=logfile)
+
+    instrument(reg)
+    capture(reg, 'registry')
+    watch(reg, 'Registry unexpectedly quit', soln)
 
     # Let the server complete startup before starting client
     try:
-        verify_alive(reg)
+        wait_listening(reg, port, timeout)
     except AbnormalTerminationError as ate:
         msg = 'Registry unexpectedly quit.'
         if soln:
@@ -1088,14 +2467,45 @@ def start_registry(exe, port, timeout, soln=True, do_debug=False):
 
     return reg
 
-def random_files(count):
-    files = []
-    for _ in range(count):
-        name = "".join(random.choices(string.ascii_letters + string.digits, k=random.randint(3, 12)))
-        files.append(name)
+@timed_phase
+def start_wire_proxy(reg, host, port, timeout, do_debug=False):
+    # Returns a node that verifies the messages peers send to the registry
+    # at host and port, peers must connect to its port
+    logfile=None
+    if do_debug:
+        logfile=sys.stdout
+    wire = wire_proxy.start(reg, host, port, timeout, split_responses=split_responses, logfile=logfile)
+    instrument(wire)
+    capture(wire, 'wire proxy')
 
-    return files
+    try:
+        verify_alive(wire)
+    except AbnormalTerminationError as ate:
+        raise InternalError('Wire proxy unexpectedly quit.') from ate
+    else:
+        atexit.register(wire.terminate, True)
+
+    if do_debug:
+        print(f'[INFO] Wire proxy on port {wire.port} for registry port {port}')
+
+    return wire
+
+def print_wire_warnings(wire):
+    for msg in wire.proxy.warnings:
+        print(f'** Warning: {msg}')
+
+def name_corpus():
+    # Names are unique over the whole run, the corpus is seeded from the
+    # random module when first used
+    global file_names
+    if file_names is None:
+        file_names = corpus.Corpus(random.getrandbits(64))
+    return file_names
 
+def random_files(count):
+    return name_corpus().batch(count)
+
+@timed_phase
 def start_peer(exe, host, port, peer_id, wd, files, shared_dir, soln=False, do_debug=False, copy=False):
     args = [host, str(port), str(peer_id)]
     if soln:
@@ -1104,17 +2514,11 @@ def start_peer(exe, host, port, peer_id, wd, files, shared_dir, soln=False, do_d
             args.append('-d')
 
     # Setup the peer files to PUBLISH
-    dst = os.path.join(wd, shared_dir)
-    os.makedirs(dst)
+    share_files(wd, shared_dir, files, copy)
     if soln:
-        shutil.copy(exe, os.path.join(wd, exe))
+        stage(exe, os.path.join(wd, exe), link=True)
     else:
         os.rename(exe, os.path.join(wd, exe))
-    for fname in files:
-        if copy:
-            shutil.copy(os.path.join(os.getcwd(), fname), dst)
-        else:
-            open(os.path.join(wd, shared_dir, fname), 'w').close()
 
     # Start the peer
     logfile=None
@@ -1126,6 +2530,9 @@ def start_peer(exe, host, port, peer_id, wd, files, shared_dir, soln=False, do_d
                          cwd=os.path.join(os.getcwd(), wd),
                          encoding='utf-8',
                          logfile=logfile)
+    instrument(peer)
+    capture(peer, f'peer {peer_id}')
+    watch(peer, 'Solution peer unexpectedly closed' if soln else 'Program unexpectedly closed', soln)
 
     try:
         verify_alive(peer)
@@ -1143,31 +2550,137 @@ def start_peer(exe, host, port, peer_id, wd, files, shared_dir, soln=False, do_d
 
     return peer
 
+@timed_phase
+def start_py_peer(host, port, peer_id, wd, files, shared_dir, do_debug=False, copy=False):
+    # Stand-in solution peer served from this process, it only REGISTERs,
+    # PUBLISHes, and serves FETCH requests
+    share_files(wd, shared_dir, files, copy)
+
+    logfile=None
+    if do_debug:
+        logfile=sys.stdout
+        print(f'[INFO] Python peer {peer_id} in {wd}')
+    peer = py_peer.start(host, port, peer_id, os.path.join(wd, shared_dir),
+                         test=True, debug=do_debug, logfile=logfile)
+    instrument(peer)
+    capture(peer, f'peer {peer_id}')
+
+    try:
+        verify_alive(peer)
+    except AbnormalTerminationError as ate:
+        print(peer.read())
+        raise InternalError('Python peer unexpectedly closed.') from ate
+    else:
+        atexit.register(peer.terminate, True)
+
+    return peer
+
+def share_files(wd, shared_dir, files, copy=False):
+    # Files to PUBLISH, staged from the current directory or created empty
+    dst = os.path.join(wd, shared_dir)
+    os.makedirs(dst)
+    for fname in files:
+        if copy:
+            stage(os.path.join(os.getcwd(), fname), dst, link=True)
+        else:
+            open(os.path.join(dst, fname), 'w').close()
+
 def parse_args():
     HELP_ARG = '-h'
     DEBUG_ARG = '-d'
     KEEP_ARG = '-k'
+    SETTLE_ARG = '-f'
+    PY_REGISTRY_ARG = '-r'
+    REBUILD_ARG = '-b'
+    WIRE_ARG = '-w'
+    SPLIT_ARG = '-u'
+    REPORT_ARG = '-j'
+    PORT_ARG = '-p'
+    SEED_ARG = '-s'
+    ALL_ARG = '-a'
+    TMP_ROOT_ARG = '-t'
 
     do_help = False
     do_debug = False
     do_keep = False
+    settle = None
+    py_registry = False
+    build_cache = True
+    wire = False
+    split = False
+    report = None
+    port = None
+    seed = None
+    result_cache = True
+    tmp_root = None
+    bad_value = None
 
     # Parse the user arguments
-    for arg in sys.argv[1:]:
+    args = iter(sys.argv[1:])
+    files = []
+    for arg in args:
         if arg == HELP_ARG:
             do_help = True
-            sys.argv.remove(arg)
         elif arg == DEBUG_ARG:
             do_debug = True
-            sys.argv.remove(arg)
         elif arg == KEEP_ARG:
             do_keep = True
-            sys.argv.remove(arg)
+        elif arg == REPORT_ARG:
+            report = next(args, None)
+            if report is None:
+                bad_value = f'{REPORT_ARG} requires a report filename.'
+            else:
+                report = os.path.abspath(report)
+        elif arg == PORT_ARG:
+            value = next(args, None)
+            try:
+                port = int(value)
+            except (TypeError, ValueError):
+                port = None
+            if port is None or not 0 < port < 2 ** 16:
+                bad_value = f'{PORT_ARG} requires a TCP port number.'
+        elif arg == SEED_ARG:
+            value = next(args, None)
+            try:
+                seed = int(value)
+            except (TypeError, ValueError):
+                bad_value = f'{SEED_ARG} requires an integer seed.'
+        elif arg == TMP_ROOT_ARG:
+            tmp_root = next(args, None)
+            if tmp_root is None or not os.path.isdir(tmp_root):
+                bad_value = f'{TMP_ROOT_ARG} requires an existing directory.'
+            else:
+                tmp_root = os.path.abspath(tmp_root)
+        elif arg == WIRE_ARG:
+            wire = True
+        elif arg == SPLIT_ARG:
+            split = True
+        elif arg == ALL_ARG:
+            result_cache = False
+        elif arg == REBUILD_ARG:
+            build_cache = False
+        elif arg == PY_REGISTRY_ARG:
+            py_registry = True
+        elif arg == SETTLE_ARG:
+            value = next(args, None)
+            try:
+                settle = float(value)
+            except (TypeError, ValueError):
+                settle = None
+            if settle is None or settle <= 0:
+                bad_value = f'{SETTLE_ARG} requires a positive number of seconds.'
         # Assume all other arguments are files
+        else:
+            files.append(arg)
+    sys.argv[1:] = files
+    if split and not wire:
+        bad_value = f'{SPLIT_ARG} requires {WIRE_ARG}.'
 
     # Print help message if needed
-    if (len(sys.argv) == 1) or do_help:
-        if len(sys.argv) == 1:
+    if (len(sys.argv) == 1) or do_help or bad_value is not None:
+        if bad_value is not None:
+            print(f'ERROR: {bad_value}\n')
+        elif len(sys.argv) == 1:
             print('ERROR: No files provided to script.\n')
 
         print(f'Usage: [options] {sys.argv[0]} <file1> <file2> ....')
@@ -1177,9 +2690,30 @@ def parse_args():
         print(f'    {DEBUG_ARG} : Print program output and debug messages. Default is off.')
         print(f'    {KEEP_ARG} : Do not delete temporary directory when script terminates.', end='')
         print(' Default is off (delete directory).')
+        print(f'    {SETTLE_ARG} <seconds> : Finish each step once the expected output arrives and', end='')
+        print(' no other output follows for <seconds>.')
+        print('         Default is off (every step waits the full timeout).')
+        print(f'    {PY_REGISTRY_ARG} : Use the built-in Python registry instead of the registry executable.', end='')
+        print(' Default is off.')
+        print(f'    {REBUILD_ARG} : Always build the executables instead of reusing a cached build of unchanged files.', end='')
+        print(' Default is off.')
+        print(f'    {WIRE_ARG} : Verify the messages sent to the registry on the wire instead of from registry output.', end='')
+        print(' Default is off.')
+        print(f'    {SPLIT_ARG} : With {WIRE_ARG}, forward each SEARCH response to the peer in two writes', end='')
+        print(' to find peers that expect it from one recv call. Default is off.')
+        print(f'    {REPORT_ARG} <file> : Write the result and timing of each test phase to <file> as JSON.', end='')
+        print(' Default is off.')
+        print(f'    {PORT_ARG} <port> : Start the registry on <port>. Default is a random port.')
+        print(f'    {SEED_ARG} <seed> : Seed for the random IDs, files, and search order, to replay a run.', end='')
+        print(' Default is the seed of the last failed run of the same files, otherwise a new seed.')
+        print(f'    {ALL_ARG} : Run every test, including those that passed in an earlier run with the same', end='')
+        print(' executables and seed. Default is off.')
+        print(f'    {TMP_ROOT_ARG} <dir> : Create the temporary directory in <dir>, such as the tmpfs /dev/shm.', end='')
+        print(' Default is the system temporary directory, or the current directory with -k.')
         sys.exit()
 
-    return do_debug, do_keep
+    return do_debug, do_keep, settle, py_registry, build_cache, wire, split, report, port, seed, result_cache, \
+        tmp_root
 
 def validate_sources(files):
 
@@ -1199,12 +2733,18 @@ def validate_sources(files):
                 print('** Warning: FD_SETSIZE constant is not permitted as an argument to select. It is not what you want/need.')
 
 def get_random_port():
-    return random.randint(2 ** 15, 2 ** 16 - 1)
+    # Not drawn from the seeded stream, a replayed seed would otherwise bind
+    # the port the failed run may have left in TIME_WAIT
+    if registry_port is not None:
+        return registry_port
+    return port_random.randint(2 ** 15, 2 ** 16 - 1)
 
 def get_random_id():
     return random.randint(2 ** 31, 2 ** 32 - 1)
 
 def banner(msg):
+    if len(phase_stack) > 0 and phase_stack[-1].title is None:
+        phase_stack[-1].title = msg
     print('\n' + '%' * len(msg))
     print(msg)
     print('%' * len(msg))
@@ -1224,8 +2764,189 @@ PREFIX = 'TEST]'
 # Error prefix printed by solutioni programs
 ERRFIX = 'ERROR]'
 
+# Either prefix followed by whitespace, the earliest in a line is used
+PREFIXES_RE = re.compile(r'(' + re.escape(PREFIX) + '|' + re.escape(ERRFIX) + r')(?=\s)')
+
+IP_RE = r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+
+# Arguments of each TEST] command, matched against the rest of the line
+# after the prefix
+COMMAND_ARGS = {
+    'JOIN': re.compile(r'\s+JOIN\s+(\d+)\s*$'),
+    'PUBLISH': re.compile(r'\s+PUBLISH\s+(\d+)\s+(.*)$'),
+    'SEARCH': re.compile(r'\s+SEARCH\s+(\S+)\s+(\d+)\s+' + IP_RE + r':(\d+)'),
+    'FETCH': re.compile(r'\s+FETCH\s+(.+)$'),
+    'REGISTER': re.compile(r'\s+REGISTER\s+(\d+)\s+' + IP_RE + r'\s*:\s*(\d+)'),
+    'ADDR': re.compile(r'\s+ADDR\s+' + IP_RE + r'\s*:\s*(\d+)'),
+}
+
+# expect() pattern lists for output that is not split into lines, compiled
+# with re.DOTALL like pexpect compiles string patterns
+JOIN_ADDR_PATTERNS = [
+    re.compile(re.escape(PREFIX) + r'\s+ADDR\s+' + IP_RE + r'\s*:\s*(\d+)[^\r]*\r\n', re.DOTALL),
+    pexpect.EOF,
+    re.compile(re.escape(ERRFIX) + r'\s+([^\r]*)\r\n', re.DOTALL),
+]
+
+SEARCH_RESPONSE_PATTERNS = [
+    # PREFIX not printed to "user"
+    re.compile(r'[^\d]*(\d+)[^\d]+' + IP_RE + r'\s*:\s*(\d+)[^\r]*\r\n', re.DOTALL),
+    re.compile(r'.*[Nn]ot\s*[Ii]ndex[^\r]*\r\n', re.DOTALL),
+    re.compile(r'.*[Nn]ot\s*[Ff]ound[^\r]*\r\n', re.DOTALL),
+    pexpect.EOF,
+    pexpect.TIMEOUT,
+]
+
+FILENAME_PROMPT_PATTERNS = [
+    re.compile(r'(?i)[^\r]*[Ff]ile\s*name[^:]*:', re.DOTALL),
+    pexpect.EOF,
+    pexpect.TIMEOUT,
+]
+
+# SEARCH queries sent at once by student_perform_search_batch, small enough
+# that the pty buffers never fill while the program is not read
+SEARCH_WINDOW = 32
+
+# Seconds a whole download may take, and may go without output or the
+# downloaded file growing, see wait_for_download
 DOWNLOAD_TIMEOUT = 300
+DOWNLOAD_STALL_TIMEOUT = 30
+
+# Characters of an unfinished line kept while waiting for a download, and
+# seconds between progress samples
+DOWNLOAD_WINDOW = 4096
+DOWNLOAD_SAMPLE_INTERVAL = 0.5
+
+LINE_END_RE = re.compile(r'\r\n|\r|\n')
+
+# Progress printed during a download: received and total ("1024/4096" or
+# "1024 of 4096"), or an amount with a unit ("1024 bytes", "1.5 MB", "40%")
+PROGRESS_PATTERNS = [
+    re.compile(r'(\d+)\s*(?:/|of)\s*\d+'),
+    re.compile(r'(\d+(?:\.\d+)?)\s*(%|[KMG]i?B\b|B\b|bytes\b)', re.IGNORECASE),
+]
+
+# Bytes read from each file at a time by compare_files
+COMPARE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Bytes shown before and after the first difference by compare_files
+HEXDUMP_CONTEXT = 32
+
+# Quiet period that ends a step after its expected output arrives, None waits
+# for the full timeout. Set by initial_setup.
+settle_timeout = None
+
+# Use the in-process py_registry in place of the registry executable. Set by
+# initial_setup.
+use_py_registry = False
+
+# Executables built from unchanged files are reused from here, see build_key
+BUILD_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'program2_check')
+
+# Passing phases of earlier runs by result key, and the seeds of failed
+# runs by submission
+RESULT_CACHE_DIR = os.path.join(BUILD_CACHE_DIR, 'results')
+
+# Files of the harness used by the calling script, part of the result key
+HARNESS_SOURCES = ['common.py', 'async_node.py', 'corpus.py', 'protocol.py', 'py_peer.py', 'py_registry.py',
+                   'stats.py', 'synthetic.py', 'wire_proxy.py']
+
+# Source of registry ports, independent of the seed, see get_random_port
+port_random = random.SystemRandom()
+
+# Output rings of every node in the order started, see capture
+rings = []
+
+# Output is printed with -d, so rings are not dumped. Set by initial_setup.
+debug_output = False
+
+# Characters of recent output kept for each node
+OUTPUT_RING_SIZE = 8192
+
+# How files were placed by stage, and the devices, as (source, destination),
+# found to have no reflinks
+staged = collections.Counter()
+no_reflink = set()
+
+# ioctl that reflinks a whole file, see reflink
+FICLONE = 0x40049409
+
+# DownloadMonitor of every FETCH test, in order
+downloads = []
+
+# Corpus of the names from random_files, see name_corpus
+file_names = None
+
+# SyntheticFile of each benchmark file by name, see benchmark_files
+synthesized = {}
+
+# Nodes started by the concurrent harness, see stop_nodes_async
+async_nodes = []
+
+# Nodes left out of phase signatures
+NODE_TYPES = (pexpect.spawnbase.SpawnBase, async_node.AsyncNode)
+
+# Nodes timed by instrument, when each last output read arrived, and when
+# output waiting to be read was first seen
+instrumented = []
+arrivals = {}
+waiting = {}
+
+# Times of the SEARCH test in progress, and the latency histograms of all
+# SEARCH tests by leg
+search_marks = {}
+latencies = {leg: stats.Histogram() for leg in ['client_to_registry', 'registry_to_response', 'end_to_end']}
+
+# Signatures of reusable phases that passed in an earlier run, and of those
+# that passed or were reused in this one
+cached_passes = set()
+reused_passes = set()
+signature_counts = {}
+
+# Reuse cached builds. Set by initial_setup.
+use_build_cache = True
+
+# Verify peer messages with wire_proxy. Set by initial_setup.
+use_wire_proxy = False
+
+# Have wire_proxy split SEARCH responses in two writes. Set by initial_setup.
+split_responses = False
+
+# Options of the calling script that change its tests, part of the result
+# key. Set by initial_setup.
+check_options = {}
+
+# settle_timeout used with the wire proxy when -f is not given
+WIRE_SETTLE_TIMEOUT = 0.1
+
+# Seconds a node has to exit after EXIT
+EXIT_TIMEOUT = 0.2
+
+# Used to poll liveness when pidfds are not available, and to wait for a
+# registry to listen on its port
+LIVENESS_POLL_INTERVAL = 0.005
+
+# Startup wait for a registry when its listening socket cannot be checked
+STARTUP_DELAY = 0.2
+
+# State of a listening socket in /proc/net/tcp
+TCP_LISTEN = '0A'
+
+# Spawned nodes whose process is watched, see watch
+watched = {}
+
+# Timing of every phase in the order the phases started, and the phases
+# currently running, innermost last. See timed_phase.
+phases = []
+phase_stack = []
+
+# Written as JSON by write_report, the script sets the result
+run_start = time.perf_counter()
+run_report = {'result': 'failed'}
 
 # Ensure any temporary directory remains in scope for the entire execution
 # Created in initial_setup
 tmp_dir = None
+
+# Registry port given with -p, otherwise None for a random port
+registry_port = None
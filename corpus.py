@@ -0,0 +1,107 @@
+#!/usr/bin/env -S python3 -B
+
+import random
+import string
+import sys
+import time
+
+import protocol
+import stats
+
+################### Defined constants ##################################
+# Characters names are drawn from, by class. A string of other characters
+# can be given instead.
+CHARACTER_CLASSES = {
+    'alnum': string.ascii_letters + string.digits,
+    'lower': string.ascii_lowercase + string.digits,
+    'hex': string.digits + 'abcdef',
+    'symbols': string.ascii_letters + string.digits + '-_+=,@',
+}
+
+# Longest name in characters, the protocol limit includes the NULL
+MAX_NAME_LENGTH = protocol.MAX_NAME_SIZE - 1
+
+################### Name generation ############################
+
+class Corpus:
+    '''Unique filenames drawn in batches from a PRNG seeded with seed. No
+    name is returned twice or matches a reserved name. Lengths are drawn from
+    lengths, weighted like random.choices, and characters from a class of
+    CHARACTER_CLASSES or a string of ASCII characters.'''
+
+    def __init__(self, seed, lengths=range(3, 13), weights=None, chars='alnum'):
+        self.rng = random.Random(seed)
+        self.lengths = list(lengths)
+        self.weights = weights
+        self.chars = CHARACTER_CLASSES.get(chars, chars)
+        if len(self.lengths) == 0 or min(self.lengths) < 1 or max(self.lengths) > MAX_NAME_LENGTH:
+            raise ValueError(f'Name lengths must be from 1 to {MAX_NAME_LENGTH}')
+        if (not self.chars.isascii() or len(set(self.chars)) != len(self.chars)
+                or '/' in self.chars or '\0' in self.chars):
+            raise ValueError('Name characters must be distinct ASCII characters other than / and NULL')
+
+        # Random bytes map to characters, those past the last whole multiple
+        # of the character count are dropped so every character is as likely
+        self.usable = 256 - 256 % len(self.chars)
+        self.table = bytes(ord(self.chars[b % len(self.chars)]) for b in range(256))
+        self.dropped = bytes(range(self.usable, 256))
+
+        self.capacity = sum(len(self.chars) ** n for n in set(self.lengths))
+        self.seen = {'.', '..'}
+
+    def reserve(self, names):
+        # Names never returned, such as names already in use
+        self.seen.update(names)
+
+    def batch(self, count):
+        if count > self.capacity - len(self.seen):
+            raise ValueError(f'Fewer than {count} unique names remain')
+
+        names = []
+        while len(names) < count:
+            # Duplicates are drawn again
+            lengths = self.rng.choices(self.lengths, self.weights, k=count - len(names))
+            text = self.characters(sum(lengths))
+            pos = 0
+            for n in lengths:
+                name = text[pos:pos + n]
+                pos += n
+                if name not in self.seen:
+                    self.seen.add(name)
+                    names.append(name)
+
+        return names
+
+    def characters(self, count):
+        out = bytearray()
+        while len(out) < count:
+            need = count - len(out)
+            out += self.rng.randbytes(need * 256 // self.usable + 16).translate(self.table, self.dropped)
+        return out[:count].decode('ascii')
+
+################### Benchmark ###################################
+
+def benchmark(count=1000000):
+    rows = []
+
+    cases = [
+        ('3-12 alnum', {}),
+        ('3-12 lower', {'chars': 'lower'}),
+        ('limit', {'lengths': [MAX_NAME_LENGTH]}),
+        ('mixed', {'lengths': [8, 32, MAX_NAME_LENGTH], 'weights': [8, 1, 1], 'chars': 'symbols'}),
+    ]
+    for label, kwargs in cases:
+        corpus = Corpus(0, **kwargs)
+        start = time.perf_counter()
+        names = corpus.batch(count)
+        elapsed = time.perf_counter() - start
+        rows.append([label, count, f'{1e9 * elapsed / count:.0f}', f'{count / elapsed / 1e6:.2f}'])
+
+    return rows
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    stats.print_table(['names', 'count', 'ns per name', 'M names/s'], benchmark(count))
+
+if __name__ == "__main__":
+    main()
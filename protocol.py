@@ -0,0 +1,407 @@
+#!/usr/bin/env -S python3 -B
+
+import socket
+import struct
+import sys
+import time
+
+import stats
+
+################### Message layouts ############################
+# Message formats used between peers and the registry, see the comments in
+# peer.c. All integers are in network byte order and all strings are NULL
+# terminated.
+#
+# JOIN      1 byte action (0), 4 byte peer ID
+# PUBLISH   1 byte action (1), 4 byte count, count filenames
+# SEARCH    1 byte action (2), filename
+#           response: 4 byte peer ID, 4 byte IPv4 address, 2 byte port
+# FETCH     1 byte action (3), filename (peer to peer only)
+#           response: 1 byte code, 0 followed by the file contents until the
+#           connection closes, or 1 if the file cannot be sent
+# REGISTER  1 byte action (4), 4 byte peer ID, 4 byte IPv4 address, 2 byte port
+
+JOIN = 0
+PUBLISH = 1
+SEARCH = 2
+FETCH = 3
+REGISTER = 4
+
+ACTION_NAMES = {
+    JOIN: 'JOIN',
+    PUBLISH: 'PUBLISH',
+    SEARCH: 'SEARCH',
+    FETCH: 'FETCH',
+    REGISTER: 'REGISTER',
+}
+
+# FETCH response codes
+FETCH_OK = 0
+FETCH_ERROR = 1
+
+# A PUBLISH message cannot be larger than this many bytes
+MAX_PUBLISH_SIZE = 1200
+
+# Filenames are at most this many bytes, including the NULL
+MAX_NAME_SIZE = 100
+
+PEER_ID = struct.Struct('!I')
+COUNT = struct.Struct('!I')
+ADDRESS = struct.Struct('!I4sH')  # SEARCH response and REGISTER body
+
+SEARCH_RESPONSE_SIZE = ADDRESS.size
+
+# Whole fixed size messages and headers, action included
+JOIN_MESSAGE = struct.Struct('!BI')
+PUBLISH_HEADER = struct.Struct('!BI')
+REGISTER_MESSAGE = struct.Struct('!BI4sH')
+
+# Bytes a StreamDecoder buffers for one message before giving up, the
+# limit of an asyncio StreamReader
+STREAM_LIMIT = 2 ** 16
+
+class ProtocolError(Exception):
+    pass
+
+class Message:
+    '''A decoded message. Filenames are memoryview slices of the buffer the
+    message was decoded from, valid until that buffer is reused.'''
+
+    __slots__ = ('action', 'size', 'peer_id', 'ip', 'port', 'count', 'names')
+
+    def __init__(self, action, size):
+        self.action = action
+        self.size = size
+        self.peer_id = None
+        self.ip = None
+        self.port = None
+        self.count = None
+        self.names = []
+
+    @property
+    def name(self):
+        # Filename of a SEARCH or FETCH
+        return self.names[0]
+
+################### Encoding functions ############################
+# The pack_* functions write one message into buf at offset with
+# struct.pack_into and return the offset after it. The buffer must have room,
+# see the *_size functions.
+
+def to_bytes(name):
+    if isinstance(name, str):
+        return name.encode()
+    return name
+
+def publish_size(names):
+    return PUBLISH_HEADER.size + sum(len(n) + 1 for n in names)
+
+def name_message_size(name):
+    return 1 + len(name) + 1
+
+def pack_join(buf, offset, peer_id):
+    JOIN_MESSAGE.pack_into(buf, offset, JOIN, peer_id)
+    return offset + JOIN_MESSAGE.size
+
+def pack_publish(buf, offset, names):
+    PUBLISH_HEADER.pack_into(buf, offset, PUBLISH, len(names))
+    pos = offset + PUBLISH_HEADER.size
+    for name in names:
+        end = pos + len(name)
+        buf[pos:end] = name
+        buf[end] = 0
+        pos = end + 1
+    return pos
+
+def pack_name_message(buf, offset, action, name):
+    end = offset + 1 + len(name)
+    buf[offset] = action
+    buf[offset + 1:end] = name
+    buf[end] = 0
+    return end + 1
+
+def pack_search(buf, offset, name):
+    return pack_name_message(buf, offset, SEARCH, name)
+
+def pack_fetch(buf, offset, name):
+    return pack_name_message(buf, offset, FETCH, name)
+
+def pack_register(buf, offset, peer_id, ip, port):
+    REGISTER_MESSAGE.pack_into(buf, offset, REGISTER, peer_id, socket.inet_aton(ip), port)
+    return offset + REGISTER_MESSAGE.size
+
+def pack_search_response(buf, offset, peer_id, ip, port):
+    ADDRESS.pack_into(buf, offset, peer_id, socket.inet_aton(ip), port)
+    return offset + ADDRESS.size
+
+class Encoder:
+    '''Encodes messages back to back into one preallocated buffer, for
+    sending several messages with one write. Each method returns the
+    encoder, view() returns the encoded bytes without copying them. A view
+    changes once the encoder is cleared, so a write that may be buffered,
+    such as to a transport, is given bytes(view()).'''
+
+    def __init__(self, size=4 * MAX_PUBLISH_SIZE):
+        self.buf = bytearray(size)
+        self.end = 0
+
+    def reserve(self, size):
+        # Grows into a new buffer so earlier views stay valid
+        if self.end + size > len(self.buf):
+            buf = bytearray(max(2 * len(self.buf), self.end + size))
+            buf[:self.end] = self.buf[:self.end]
+            self.buf = buf
+
+    def clear(self):
+        self.end = 0
+        return self
+
+    def view(self):
+        return memoryview(self.buf)[:self.end]
+
+    def join(self, peer_id):
+        self.reserve(JOIN_MESSAGE.size)
+        self.end = pack_join(self.buf, self.end, peer_id)
+        return self
+
+    def publish(self, names):
+        names = [to_bytes(n) for n in names]
+        self.reserve(publish_size(names))
+        self.end = pack_publish(self.buf, self.end, names)
+        return self
+
+    def search(self, name):
+        name = to_bytes(name)
+        self.reserve(name_message_size(name))
+        self.end = pack_search(self.buf, self.end, name)
+        return self
+
+    def fetch(self, name):
+        name = to_bytes(name)
+        self.reserve(name_message_size(name))
+        self.end = pack_fetch(self.buf, self.end, name)
+        return self
+
+    def register(self, peer_id, ip, port):
+        self.reserve(REGISTER_MESSAGE.size)
+        self.end = pack_register(self.buf, self.end, peer_id, ip, port)
+        return self
+
+    def search_response(self, peer_id, ip, port):
+        self.reserve(ADDRESS.size)
+        self.end = pack_search_response(self.buf, self.end, peer_id, ip, port)
+        return self
+
+# Single messages as new bytes objects
+
+def encode_join(peer_id):
+    return JOIN_MESSAGE.pack(JOIN, peer_id)
+
+def encode_publish(names):
+    names = [to_bytes(n) for n in names]
+    buf = bytearray(publish_size(names))
+    pack_publish(buf, 0, names)
+    return bytes(buf)
+
+def encode_search(name):
+    return bytes([SEARCH]) + to_bytes(name) + b'\0'
+
+def encode_fetch(name):
+    return bytes([FETCH]) + to_bytes(name) + b'\0'
+
+def encode_register(peer_id, ip, port):
+    return REGISTER_MESSAGE.pack(REGISTER, peer_id, socket.inet_aton(ip), port)
+
+def encode_search_response(peer_id, ip, port):
+    return ADDRESS.pack(peer_id, socket.inet_aton(ip), port)
+
+################### Decoding functions ############################
+# buf is a bytes-like object that supports find(), such as bytes or
+# bytearray, and view is a memoryview of it. Messages are decoded from
+# view[start:end].
+
+def message_size(buf, start, end):
+    # Size of the message at start, None if more bytes are needed, 1 for an
+    # unknown action
+    action = buf[start]
+    if action == JOIN:
+        size = JOIN_MESSAGE.size
+    elif action == REGISTER:
+        size = REGISTER_MESSAGE.size
+    elif action in (SEARCH, FETCH):
+        nul = buf.find(b'\0', start + 1, end)
+        return None if nul == -1 else nul + 1 - start
+    elif action == PUBLISH:
+        pos = start + PUBLISH_HEADER.size
+        if end < pos:
+            return None
+        count, = COUNT.unpack_from(buf, start + 1)
+        for _ in range(count):
+            nul = buf.find(b'\0', pos, end)
+            if nul == -1:
+                return None
+            pos = nul + 1
+        return pos - start
+    else:
+        return 1
+    return size if end - start >= size else None
+
+def decode_message(buf, view, start, end):
+    # The complete message at start, or None
+    size = message_size(buf, start, end)
+    if size is None:
+        return None
+
+    action = buf[start]
+    msg = Message(action, size)
+    if action == JOIN:
+        msg.peer_id, = PEER_ID.unpack_from(buf, start + 1)
+    elif action == REGISTER:
+        msg.peer_id, msg.ip, msg.port = decode_address_from(buf, start + 1)
+    elif action in (SEARCH, FETCH):
+        msg.names = [view[start + 1:start + size - 1]]
+    elif action == PUBLISH:
+        msg.count, = COUNT.unpack_from(buf, start + 1)
+        pos = start + PUBLISH_HEADER.size
+        for _ in range(msg.count):
+            nul = buf.find(b'\0', pos, end)
+            msg.names.append(view[pos:nul])
+            pos = nul + 1
+
+    return msg
+
+def decode_address_from(buf, offset):
+    peer_id, ip, port = ADDRESS.unpack_from(buf, offset)
+    return peer_id, socket.inet_ntoa(ip), port
+
+def decode_address(data):
+    return decode_address_from(data, 0)
+
+def decode_search_response(data):
+    return decode_address_from(data, 0)
+
+def decode_register(data):
+    return decode_address_from(data, 0)
+
+class StreamDecoder:
+    '''Incremental decoder for a byte stream. Bytes are received directly
+    into the decoder with buffer() and received(), as asyncio's
+    BufferedProtocol does, or copied in with feed(). Complete messages are
+    returned by messages() and partial ones are kept for the next read.
+
+    Requests are decoded into Message objects, and with responses=True the
+    stream is SEARCH responses decoded as (peer ID, IP, port). Filenames
+    point into the buffer and are valid until the next read.'''
+
+    def __init__(self, size=STREAM_LIMIT, responses=False, limit=STREAM_LIMIT):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.responses = responses
+        self.limit = limit
+
+    def pending(self):
+        return self.end - self.start
+
+    def buffer(self, sizehint=-1):
+        # Free space after the received bytes. Partial messages are moved to
+        # the front first, into a new buffer if more room is needed.
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf) or sizehint > len(self.buf) - self.end:
+            pending = self.end - self.start
+            if pending >= len(self.buf) // 2:
+                buf = bytearray(2 * len(self.buf))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        return self.view[self.end:]
+
+    def received(self, nbytes):
+        self.end += nbytes
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data):
+            free = self.buffer(len(data) - pos)
+            n = min(len(free), len(data) - pos)
+            free[:n] = data[pos:pos + n]
+            self.received(n)
+            pos += n
+
+    def messages(self):
+        # Complete messages, raises ProtocolError once a partial message is
+        # larger than the limit
+        found = []
+        while self.start < self.end:
+            if self.responses:
+                if self.end - self.start < ADDRESS.size:
+                    break
+                found.append(decode_address_from(self.buf, self.start))
+                self.start += ADDRESS.size
+                continue
+
+            msg = decode_message(self.buf, self.view, self.start, self.end)
+            if msg is None:
+                break
+            found.append(msg)
+            self.start += msg.size
+
+        if self.end - self.start > self.limit:
+            raise ProtocolError(f'Message larger than {self.limit} bytes.')
+        return found
+
+    def clear(self):
+        self.start = self.end = 0
+
+    def partial(self):
+        # The received bytes of an incomplete message
+        return self.view[self.start:self.end]
+
+################### Benchmark ###################################
+
+def benchmark(count=200000):
+    names = [f'file{i:02d}.txt'.encode() for i in range(12)]
+    encoder = Encoder()
+    rows = []
+
+    cases = [
+        ('JOIN', lambda e: e.join(123456789)),
+        ('PUBLISH', lambda e: e.publish(names)),
+        ('SEARCH', lambda e: e.search(b'something.pptx')),
+        ('FETCH', lambda e: e.fetch(b'something.pptx')),
+        ('REGISTER', lambda e: e.register(123456789, '10.0.0.1', 40000)),
+    ]
+    for label, encode in cases:
+        start = time.perf_counter()
+        for _ in range(count):
+            encode(encoder.clear())
+        encoded = time.perf_counter() - start
+
+        # Many messages back to back, decoded in 1500 byte reads
+        stream = memoryview(bytes(encode(encoder.clear()).view()) * 1000)
+        decoder = StreamDecoder()
+        decoded = 0
+        start = time.perf_counter()
+        while decoded < count:
+            for pos in range(0, len(stream), 1500):
+                decoder.feed(stream[pos:pos + 1500])
+                decoded += len(decoder.messages())
+        elapsed = time.perf_counter() - start
+
+        rows.append([label, len(stream) // 1000, f'{1e9 * encoded / count:.0f}',
+                     f'{1e9 * elapsed / decoded:.0f}', f'{len(stream) * decoded / 1000 / elapsed / 1e6:.0f}'])
+
+    return rows
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    stats.print_table(['message', 'bytes', 'encode ns', 'decode ns', 'decode MB/s'], benchmark(count))
+
+if __name__ == "__main__":
+    main()
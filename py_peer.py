@@ -0,0 +1,207 @@
+import asyncio
+import os
+import socket
+import threading
+
+import pexpect.fdpexpect
+
+import protocol
+
+################### Defined constants ##################################
+# Seconds a command typed to a stand-in peer may take to complete
+COMMAND_TIMEOUT = 5
+
+################### Peer ###################################
+
+class Peer:
+    '''Stand-in for a solution peer that only serves files. REGISTERs with
+    the registry, PUBLISHes the files in its shared directory, and answers
+    FETCH requests with os.sendfile. Prints the same TEST] lines as the
+    solution peer, output is passed to write() as bytes.'''
+
+    def __init__(self, host, port, peer_id, shared_dir, write, test=False, debug=False, newline=b'\r\n'):
+        self.host = host
+        self.registry_port = port
+        self.peer_id = peer_id
+        self.shared_dir = shared_dir
+        self.write = write
+        self.test = test
+        self.do_debug = debug
+        self.newline = newline
+
+        self.encoder = protocol.Encoder()
+        self.registry = None
+        self.server = None
+        self.ip = None
+        self.port = None
+        self.running = False
+
+    def test_line(self, *fields):
+        if self.test:
+            self.write(b'TEST] ' + b' '.join(map(to_field, fields)) + self.newline)
+
+    def error(self, msg):
+        self.write(f'ERROR] (PEER) {msg}'.encode() + self.newline)
+
+    def debug(self, msg):
+        if self.do_debug:
+            self.write(f'DEBUG] (PEER) {msg}'.encode() + self.newline)
+
+    async def start(self):
+        # Listens on the address the registry connection uses, the address
+        # other peers are given by SEARCH
+        try:
+            _, self.registry = await asyncio.open_connection(self.host, self.registry_port)
+            ip = self.registry.get_extra_info('sockname')[0]
+            self.server = await asyncio.start_server(self.serve_fetch, host=ip, port=0,
+                                                     family=socket.AF_INET)
+        except OSError as err:
+            self.error(f'Unable to start: {err.strerror}')
+            return False
+        self.ip, self.port = self.server.sockets[0].getsockname()[:2]
+        self.running = True
+        self.debug(f'Peer {self.peer_id} listening at {self.ip}:{self.port}')
+        return True
+
+    async def command(self, line):
+        if line == 'REGISTER':
+            self.test_line('ADDR', f'{self.ip}:{self.port}')
+            await self.send(self.encoder.clear().register(self.peer_id, self.ip, self.port))
+        elif line == 'PUBLISH':
+            names = sorted(f for f in os.listdir(self.shared_dir)
+                           if os.path.isfile(os.path.join(self.shared_dir, f)))
+            await self.send(self.encoder.clear().publish(names))
+        elif line == 'EXIT':
+            await self.stop()
+        elif line != '':
+            self.error(f'Command {line} not supported by stand-in peer')
+
+    async def send(self, encoder):
+        self.registry.write(bytes(encoder.view()))
+        await self.registry.drain()
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.server.close()
+        self.registry.close()
+        self.debug(f'Peer {self.peer_id} closed.')
+
+    async def serve_fetch(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            action = (await reader.readexactly(1))[0]
+            name = (await reader.readuntil(b'\0'))[:-1]
+            if action != protocol.FETCH:
+                self.error(f'Invalid operation ({action}) from peer')
+                return
+            self.test_line('FETCH', name)
+
+            fname = name.decode(errors='replace')
+            path = os.path.join(self.shared_dir, fname)
+            if os.path.basename(fname) != fname or not os.path.isfile(path):
+                self.error(f'FETCH for unknown file {fname}')
+                writer.write(bytes([protocol.FETCH_ERROR]))
+                await writer.drain()
+                return
+
+            writer.write(bytes([protocol.FETCH_OK]))
+            with open(path, 'rb') as f:
+                await loop.sendfile(writer.transport, f)
+            self.debug(f'Sent {fname}')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def to_field(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+################### In-process peers ###################################
+
+class PeerLoop:
+    '''Event loop in a background thread shared by every stand-in peer of
+    the process, started with the first peer.'''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout=COMMAND_TIMEOUT):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+class PeerNode(pexpect.fdpexpect.fdspawn):
+    '''pexpect interface to a stand-in Peer, used in place of a spawned
+    solution peer. Lines sent to the node are run as peer commands.'''
+
+    def __init__(self, fd, write_fd, **kwargs):
+        super().__init__(fd, **kwargs)
+        self.peer = None
+        self.write_fd = write_fd
+        self.write_lock = threading.Lock()
+        self.typed = ''
+        self.exitstatus = None
+
+    def isalive(self):
+        return self.peer.running and super().isalive()
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        self.typed += s
+        *lines, self.typed = self.typed.split('\n')
+        for line in lines:
+            run_command(self, line.strip())
+        return len(s)
+
+    def terminate(self, force=False):
+        stop(self)
+        return True
+
+    def write(self, data):
+        # Peer output, dropped once the node is closed
+        with self.write_lock:
+            view = memoryview(data)
+            while len(view) > 0 and self.write_fd != -1:
+                view = view[os.write(self.write_fd, view):]
+
+def run_command(node, line):
+    try:
+        peer_loop.run(node.peer.command(line))
+    except TimeoutError:
+        node.peer.error(f'{line} did not complete within {COMMAND_TIMEOUT} seconds')
+    except OSError as err:
+        node.peer.error(f'{line} failed: {err.strerror}')
+    if not node.peer.running:
+        node.exitstatus = 0
+        close_output(node)
+
+def stop(node):
+    if node.peer.running:
+        peer_loop.run(node.peer.stop())
+    close_output(node)
+
+def close_output(node):
+    with node.write_lock:
+        if node.write_fd != -1:
+            os.close(node.write_fd)
+            node.write_fd = -1
+
+def start(host, port, peer_id, shared_dir, timeout=30, test=False, debug=False, logfile=None):
+    global peer_loop
+    if peer_loop is None:
+        peer_loop = PeerLoop()
+
+    read_fd, write_fd = os.pipe()
+    node = PeerNode(read_fd, write_fd, timeout=timeout, encoding='utf-8', logfile=logfile)
+    node.peer = Peer(host, port, peer_id, os.path.abspath(shared_dir), node.write, test=test, debug=debug)
+    if not peer_loop.run(node.peer.start()):
+        close_output(node)
+
+    return node
+
+peer_loop = None
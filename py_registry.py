@@ -0,0 +1,321 @@
+#!/usr/bin/env -S python3 -B
+
+import asyncio
+import os
+import random
+import socket
+import sys
+import threading
+
+import pexpect.fdpexpect
+
+import protocol
+
+################### Defined constants ##################################
+# Files published by the virtual peers created in testing mode, these match
+# the virtual peers created by p2_registry.
+VIRTUAL_FILES = [
+    ['from.tgz', 'yes.txt', 'nope.txt'],
+    ['blank', 'something.pptx'],
+]
+
+# Pending connections allowed on the listening socket
+BACKLOG = 4096
+
+################### Registry ###################################
+
+class PeerRecord:
+    def __init__(self, peer_id, ip, port):
+        self.peer_id = peer_id
+        self.ip = ip
+        self.port = port
+        self.files = []
+
+class Registry:
+    '''Stand-in for the p2_registry executable. Handles JOIN, REGISTER,
+    PUBLISH, and SEARCH messages and prints the same TEST] and ERROR] lines
+    as p2_registry. p2_registry reads the filename of a FETCH and the rest
+    of an unterminated filename as further messages. Here the FETCH filename
+    is skipped, and an unterminated filename is reported with its own ERROR]
+    line and closes the connection. Output is passed to write() as bytes.'''
+
+    def __init__(self, write, test=False, debug=False, newline=b'\n'):
+        self.write = write
+        self.test = test
+        self.do_debug = debug
+        self.newline = newline
+
+        # Peer ID -> PeerRecord
+        self.peers = {}
+        # Filename -> peer IDs that published it, in PUBLISH order
+        self.index = {}
+
+        if test:
+            self.add_virtual_peers()
+
+    def add_virtual_peers(self):
+        for files in VIRTUAL_FILES:
+            peer_id = random.randint(2 ** 31, 2 ** 32 - 1)
+            ip = socket.inet_ntoa(random.getrandbits(32).to_bytes(4, 'big'))
+            port = random.randint(2 ** 15, 2 ** 16 - 1)
+            record = PeerRecord(peer_id, ip, port)
+            self.peers[peer_id] = record
+            self.add_files(record, [f.encode() for f in files])
+            self.debug(f'Virtual peer {peer_id} at {ip}:{port} with files {" ".join(files)}')
+
+    def add_files(self, record, names):
+        for name in names:
+            record.files.append(name)
+            self.index.setdefault(name, {})[record.peer_id] = None
+
+    def remove_peer(self, record):
+        if self.peers.get(record.peer_id) is not record:
+            return
+        del self.peers[record.peer_id]
+        for name in record.files:
+            holders = self.index.get(name)
+            if holders is None:
+                continue
+            holders.pop(record.peer_id, None)
+            if len(holders) == 0:
+                del self.index[name]
+
+    def search(self, name, record):
+        # A peer never finds its own files
+        for peer_id in self.index.get(name, ()):
+            if record is None or peer_id != record.peer_id:
+                return self.peers[peer_id]
+        return None
+
+    def test_line(self, *fields):
+        if self.test:
+            self.write(b'TEST] ' + b' '.join(map(to_field, fields)) + self.newline)
+
+    def error(self, msg):
+        self.write(f'ERROR] (REGISTRY) {msg}'.encode() + self.newline)
+
+    def debug(self, msg):
+        if self.do_debug:
+            self.write(f'DEBUG] (REGISTRY) {msg}'.encode() + self.newline)
+
+    def connection(self):
+        return PeerConnection(self)
+
+    def handle(self, conn, msg):
+        # Handles one message from conn, SEARCH responses are added to
+        # conn.responses. Returns True if conn must be closed.
+        record = conn.record
+        action = msg.action
+        if action == protocol.JOIN:
+            if record is not None:
+                self.error(f'Peer {record.peer_id} attempting to JOIN again as peer {msg.peer_id}')
+                return
+            conn.record = PeerRecord(msg.peer_id, conn.ip, conn.port)
+            self.peers[msg.peer_id] = conn.record
+            self.debug(f'Peer {msg.peer_id} JOIN request')
+            self.test_line('JOIN', msg.peer_id)
+        elif action == protocol.REGISTER:
+            if record is not None:
+                self.error(f'Peer {record.peer_id} attempting to REGISTER again as peer {msg.peer_id}')
+                return
+            conn.record = PeerRecord(msg.peer_id, msg.ip, msg.port)
+            self.peers[msg.peer_id] = conn.record
+            self.debug(f'Peer {msg.peer_id} ({msg.ip}:{msg.port}) REGISTER request')
+            self.test_line('REGISTER', msg.peer_id, f'{msg.ip}:{msg.port}')
+        elif action == protocol.PUBLISH:
+            if record is None:
+                self.error('PUBLISH received from unregistered peer')
+                return
+            names = [bytes(n) for n in msg.names]
+            self.add_files(record, names)
+            self.debug(f'Peer {record.peer_id} PUBLISH message')
+            self.test_line('PUBLISH', msg.count, b''.join(n + b' ' for n in names))
+        elif action == protocol.SEARCH:
+            if record is None:
+                # Answered as not found without searching
+                self.error('SEARCH received from unregistered peer')
+                conn.responses.search_response(0, '0.0.0.0', 0)
+                return
+            name = bytes(msg.name)
+            if len(name) == 0:
+                self.error(f'Missing filename for SEARCH from peer {record.peer_id}')
+                return True
+            if b'\n' in name:
+                self.error('Filename in SEARCH contains a newline')
+                return True
+            found = self.search(name, record)
+            if found is None:
+                result = (0, '0.0.0.0', 0)
+            else:
+                result = (found.peer_id, found.ip, found.port)
+            conn.responses.search_response(*result)
+            self.test_line('SEARCH', name, result[0], f'{result[1]}:{result[2]}')
+        elif action == protocol.FETCH:
+            self.error(f'FETCH command (from {describe(record)}) not supported by Registry')
+        elif record is None:
+            self.error(f'Invalid operation ({action}) from unregistered peer')
+        else:
+            self.error(f'Invalid operation ({action}) from peer {record.peer_id}')
+
+class PeerConnection(asyncio.BufferedProtocol):
+    '''Connection from one peer. Bytes are received straight into the
+    decoder's buffer and the SEARCH responses to everything decoded from one
+    read are sent with a single write.'''
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.decoder = protocol.StreamDecoder()
+        self.responses = protocol.Encoder()
+        self.transport = None
+        self.record = None
+        self.ip = None
+        self.port = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.ip, self.port = transport.get_extra_info('peername')[:2]
+        self.registry.debug('New peer connecting to registry.')
+
+    def get_buffer(self, sizehint):
+        return self.decoder.buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.received(nbytes)
+        try:
+            messages = self.decoder.messages()
+        except protocol.ProtocolError:
+            self.registry.error(f'Unterminated filename from {describe(self.record)}')
+            self.transport.close()
+            return
+
+        self.responses.clear()
+        for msg in messages:
+            if self.registry.handle(self, msg):
+                self.transport.write(bytes(self.responses.view()))
+                self.transport.close()
+                return
+        self.transport.write(bytes(self.responses.view()))
+
+    def pause_writing(self):
+        # A peer that does not read its responses is not read from either
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.record is not None:
+            self.registry.debug(f'Peer {self.record.peer_id} closed connection.')
+            self.registry.remove_peer(self.record)
+
+def to_field(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+def describe(record):
+    return 'unregistered peer' if record is None else f'peer {record.peer_id}'
+
+################### In-process registry ###################################
+
+class RegistryServer:
+    '''Runs a Registry on its own event loop in a background thread. Output is
+    written to write_fd.'''
+
+    def __init__(self, port, write_fd, test=False, debug=False):
+        self.port = port
+        self.write_fd = write_fd
+        self.registry = Registry(self.write, test=test, debug=debug, newline=b'\r\n')
+        self.loop = None
+        self.stopping = None
+        self.running = False
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        if self.loop is not None and self.running:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join(1)
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self.write_fd, view):]
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        try:
+            server = await self.loop.create_server(self.registry.connection, port=self.port,
+                                                   family=socket.AF_INET, reuse_address=True,
+                                                   backlog=BACKLOG)
+        except OSError as err:
+            # Report like a registry that failed to start, closing the output
+            self.registry.error(f'Unable to listen on port {self.port}: {err.strerror}')
+        else:
+            self.running = True
+            self.started.set()
+            async with server:
+                await self.stopping.wait()
+        finally:
+            self.running = False
+            self.started.set()
+            os.close(self.write_fd)
+
+class RegistryNode(pexpect.fdpexpect.fdspawn):
+    '''pexpect interface to a RegistryServer, used in place of a spawned
+    p2_registry.'''
+
+    def __init__(self, server, fd, **kwargs):
+        super().__init__(fd, **kwargs)
+        self.server = server
+        self.exitstatus = None
+
+    def isalive(self):
+        return self.server.running and super().isalive()
+
+    def terminate(self, force=False):
+        self.server.stop()
+        return True
+
+def start(port, timeout, test=False, debug=False, logfile=None):
+    read_fd, write_fd = os.pipe()
+    server = RegistryServer(port, write_fd, test=test, debug=debug)
+    server.start()
+
+    return RegistryNode(server, read_fd, timeout=timeout, encoding='utf-8', logfile=logfile)
+
+################### Command line ###################################
+
+def main():
+    if len(sys.argv) < 2 or not sys.argv[1].isdigit() or any(a not in ('-d', '-t') for a in sys.argv[2:]):
+        print(f'Usage: {sys.argv[0]} <port> [-d|-t]')
+        print('  -t: Enable testing operation, which creates virtual peer entries and prints a summary of all commands received.')
+        print('  -d: Enable debug output.')
+        print('  Optional arguments must come after the port argument.')
+        sys.exit(1)
+
+    def write(data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    registry = Registry(write, test='-t' in sys.argv[2:], debug='-d' in sys.argv[2:])
+
+    async def serve():
+        server = await asyncio.get_running_loop().create_server(
+            registry.connection, port=int(sys.argv[1]), family=socket.AF_INET,
+            reuse_address=True, backlog=BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
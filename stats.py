@@ -0,0 +1,120 @@
+import math
+
+################### Latency statistics ############################
+
+# Percentiles reported by summarize, as (label, fraction)
+PERCENTILES = [('p50', 0.50), ('p99', 0.99), ('p999', 0.999)]
+
+# Percentiles reported by Histogram.to_dict
+HISTOGRAM_PERCENTILES = [('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('p999', 0.999)]
+
+def percentile(values, fraction):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if len(values) == 0:
+        return None
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+def summarize(samples, elapsed):
+    '''Count, rate over elapsed seconds, and latency percentiles in ms.'''
+    values = sorted(samples)
+    summary = {
+        'count': len(values),
+        'rate': len(values) / elapsed if elapsed > 0 else 0.0,
+    }
+    for label, fraction in PERCENTILES:
+        value = percentile(values, fraction)
+        summary[label] = None if value is None else value * 1000
+    summary['max'] = values[-1] * 1000 if values else None
+
+    return summary
+
+def loglog_slope(xs, ys):
+    '''Least squares slope of log(y) over log(x). Near 0 when y does not
+    depend on x, near 1 when y grows linearly with x.'''
+    points = [(math.log(x), math.log(y)) for x, y in zip(xs, ys) if x > 0 and y is not None and y > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if var == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+class Histogram:
+    '''Latency histogram in the style of HdrHistogram. Values are counted
+    in whole units, exactly below 2 ** bits and otherwise in buckets that
+    split each power of two into 2 ** (bits - 1) equal parts, so every value
+    keeps the same relative precision, under 1% with the default 8 bits.'''
+
+    def __init__(self, unit=1e-6, bits=8):
+        self.unit = unit
+        self.bits = bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        if value < 1 << self.bits:
+            return value
+        shift = value.bit_length() - self.bits
+        return (shift << (self.bits - 1)) + (value >> shift)
+
+    def bucket(self, index):
+        # Lowest and highest value counted in the bucket at index
+        if index < 1 << self.bits:
+            return index, index
+        shift = (index >> (self.bits - 1)) - 1
+        top = index - (shift << (self.bits - 1))
+        return top << shift, ((top + 1) << shift) - 1
+
+    def record(self, seconds):
+        seconds = max(0.0, seconds)
+        i = self.index(int(seconds / self.unit))
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, fraction):
+        '''Highest value in the bucket holding the nearest-rank percentile, no
+        more than the largest value recorded, in seconds.'''
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.bucket(i)[1] * self.unit, self.max)
+
+    def to_dict(self):
+        summary = {
+            'count': self.count,
+            'min_ms': None if self.min is None else self.min * 1000,
+            'mean_ms': self.total / self.count * 1000 if self.count else None,
+            'max_ms': None if self.max is None else self.max * 1000,
+        }
+        for label, fraction in HISTOGRAM_PERCENTILES:
+            value = self.percentile(fraction)
+            summary[f'{label}_ms'] = None if value is None else value * 1000
+        # Lowest value of each bucket in ms with its count
+        summary['buckets'] = [[self.bucket(i)[0] * self.unit * 1000, self.counts[i]] for i in sorted(self.counts)]
+
+        return summary
+
+def format_ms(value):
+    if value is None:
+        return '-'
+    return f'{value:.3f}'
+
+def print_table(headers, rows):
+    widths = [max(len(str(c)) for c in col) for col in zip(headers, *rows)]
+    print('  '.join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    print('  '.join('-' * w for w in widths))
+    for row in rows:
+        print('  '.join(str(c).rjust(w) for c, w in zip(row, widths)))
@@ -0,0 +1,169 @@
+#!/usr/bin/env -S python3 -B
+
+import hashlib
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+import stats
+
+################### Defined constants ##################################
+# Bytes in each block of a synthetic file, each either zeros or random
+BLOCK_SIZE = 1024 * 1024
+
+# Fraction of blocks left as zeros, holes in the written file
+ZERO_FRACTION = 0.5
+
+# Key of the random contents of a block, the seed and block number
+BLOCK_KEY = struct.Struct('!QQ')
+
+################### Synthetic files ############################
+
+class SyntheticFile:
+    '''Contents of a file of size bytes made from seed alone. The file is
+    a run of BLOCK_SIZE blocks, each zeros or random bytes keyed by the seed
+    and the block number, so any part is regenerated without reading the
+    file. Zero blocks are left as holes when written.'''
+
+    def __init__(self, seed, size, zero_fraction=ZERO_FRACTION, block_size=BLOCK_SIZE):
+        self.seed = seed
+        self.size = size
+        self.block_size = block_size
+        self.zero_fraction = zero_fraction
+
+        rng = random.Random(seed)
+        count = -(-size // block_size)
+        self.zero = [rng.random() < zero_fraction for _ in range(count)]
+        self.zeros = bytes(block_size)
+
+    def block(self, i):
+        # Contents of block i, shorter at the end of the file
+        length = min(self.block_size, self.size - i * self.block_size)
+        if self.zero[i]:
+            return self.zeros[:length] if length < self.block_size else self.zeros
+        return hashlib.shake_128(BLOCK_KEY.pack(self.seed, i)).digest(length)
+
+    def data_bytes(self):
+        # Bytes not in zero blocks, those written to disk
+        return sum(min(self.block_size, self.size - i * self.block_size)
+                   for i, zero in enumerate(self.zero) if not zero)
+
+    def write(self, path):
+        # Only random blocks are written, the rest of the file is a hole
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            for i, zero in enumerate(self.zero):
+                if zero:
+                    continue
+                view = memoryview(self.block(i))
+                offset = i * self.block_size
+                while len(view) > 0:
+                    n = os.pwrite(fd, view, offset)
+                    view = view[n:]
+                    offset += n
+        finally:
+            os.close(fd)
+
+    def pread(self, length, offset):
+        # Up to length bytes at offset, like os.pread of the written file
+        data = bytearray()
+        end = min(offset + length, self.size)
+        while offset < end:
+            i, start = divmod(offset, self.block_size)
+            chunk = self.block(i)[start:start + end - offset]
+            data += chunk
+            offset += len(chunk)
+        return bytes(data)
+
+    def reader(self):
+        return SyntheticReader(self)
+
+    def to_dict(self):
+        return {
+            'seed': self.seed,
+            'bytes': self.size,
+            'block_size': self.block_size,
+            'zero_fraction': self.zero_fraction,
+            'data_bytes': self.data_bytes(),
+        }
+
+class SyntheticReader:
+    '''Regenerated contents of a SyntheticFile read in order with
+    readinto, like an unbuffered file.'''
+
+    def __init__(self, synthetic):
+        self.synthetic = synthetic
+        self.offset = 0
+        self.index = -1
+        self.current = b''
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        total = 0
+        while total < len(view) and self.offset < self.synthetic.size:
+            i, start = divmod(self.offset, self.synthetic.block_size)
+            if i != self.index:
+                self.index = i
+                self.current = self.synthetic.block(i)
+            n = min(len(view) - total, len(self.current) - start)
+            view[total:total + n] = self.current[start:start + n]
+            total += n
+            self.offset += n
+        return total
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+################### Benchmark ###################################
+
+def benchmark(size=1 << 30):
+    # Writing and reading back a synthetic file against a file of random
+    # bytes of the same size
+    rows = []
+    chunk = bytearray(4 * 1024 * 1024)
+    with tempfile.TemporaryDirectory(dir='.') as d:
+        synthetic = SyntheticFile(0, size)
+        path = os.path.join(d, 'synthetic')
+        start = time.perf_counter()
+        synthetic.write(path)
+        written = time.perf_counter() - start
+        start = time.perf_counter()
+        with synthetic.reader() as r:
+            while r.readinto(chunk):
+                pass
+        regenerated = time.perf_counter() - start
+        rows.append(['synthetic', size, synthetic.data_bytes(), os.stat(path).st_blocks * 512,
+                     f'{size / written / 1e6:.0f}', f'{size / regenerated / 1e6:.0f}'])
+
+        path = os.path.join(d, 'random')
+        start = time.perf_counter()
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                n = min(remaining, len(chunk))
+                f.write(random.randbytes(n))
+                remaining -= n
+        written = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path, 'rb', buffering=0) as f:
+            while f.readinto(chunk):
+                pass
+        read = time.perf_counter() - start
+        rows.append(['random', size, size, os.stat(path).st_blocks * 512,
+                     f'{size / written / 1e6:.0f}', f'{size / read / 1e6:.0f}'])
+
+    return rows
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 30
+    stats.print_table(['file', 'bytes', 'data bytes', 'disk bytes', 'create MB/s', 'read MB/s'], benchmark(size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import sys
+import time
+
+import pexpect
+
+import common
+
+# A peer that prints progress while it writes a download, then its prompt
+# without a line ending
+PROGRESS_PEER = '''
+import sys, time
+with open(sys.argv[1], 'wb') as f:
+    for received in range(1024, 5 * 1024, 1024):
+        f.write(bytes(1024))
+        f.flush()
+        print(f'Received {received}/4096 bytes', flush=True)
+        time.sleep(0.3)
+print('What would you like to do?: ', end='', flush=True)
+time.sleep(5)
+'''
+
+def spawn_peer(script, *args):
+    return pexpect.spawn(sys.executable, ['-c', script, *args], encoding='utf-8', timeout=5)
+
+def test_unterminated_prompt_ends_download():
+    monitor = common.DownloadMonitor('f', '/nonexistent', 4096)
+    assert monitor.feed('Received 1024/4096\r\n') is None
+    assert monitor.feed('Received 2048/4096') is None
+    assert monitor.feed('\r\nWhat would you like to do?:') == ''
+
+def test_progress_sampled_during_download(tmp_path):
+    dst_path = tmp_path / 'download'
+    peer = spawn_peer(PROGRESS_PEER, str(dst_path))
+    try:
+        monitor = common.DownloadMonitor('download', str(dst_path), 4096)
+        common.run(common.wait_for_download(peer, monitor))
+        waited = time.perf_counter() - monitor.start
+    finally:
+        peer.terminate(True)
+
+    assert monitor.received == 4096
+    assert len(monitor.samples) >= 1
+    assert all(rate > 0 for _, _, rate in monitor.samples)
+    # The prompt ends the wait as soon as it is printed
+    assert waited < 4 * 0.3 + common.DOWNLOAD_SAMPLE_INTERVAL / 2
@@ -0,0 +1,121 @@
+import atexit
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import common
+
+################### Defined constants ##################################
+# Checked by run_check, relative to this file
+CHECK_SCRIPT = 'program2_check'
+
+# Seconds a check run by run_check may take before it is killed
+CHECK_TIMEOUT = 600
+
+# Seconds the load tools wait for a started registry to accept connections
+LOAD_STARTUP_TIMEOUT = 5
+
+################### Batch functions ###################################
+
+class PortAllocator:
+    '''Registry ports for checks run at the same time. A port is given out
+    again only once released, and only if nothing else is bound to it.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.given = set()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                port = random.randint(2 ** 15, 2 ** 16 - 1)
+                if port not in self.given and port_free(port):
+                    self.given.add(port)
+                    return port
+
+    def release(self, port):
+        with self.lock:
+            self.given.discard(port)
+
+def port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('', port))
+        except OSError:
+            return False
+    return True
+
+def run_check(args, ports, report, timeout):
+    # Runs program2_check with args on its own registry port in a separate
+    # process. Returns the result, output, and phases of its run report.
+    port = ports.acquire()
+    cmd = [os.path.join(os.path.dirname(os.path.abspath(__file__)), CHECK_SCRIPT)]
+    cmd += args + ['-p', str(port), '-j', report]
+
+    result = {'port': port}
+    start = time.perf_counter()
+    try:
+        proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, timeout=timeout)
+        output = proc.stdout
+        result['exit_status'] = proc.returncode
+    except subprocess.TimeoutExpired as err:
+        output = err.output or b''
+        result['exit_status'] = None
+    finally:
+        ports.release(port)
+    result['seconds'] = time.perf_counter() - start
+    result['output'] = output.decode(errors='replace')
+
+    try:
+        with open(report) as f:
+            run = json.load(f)
+        result['result'] = run['result']
+        result['seed'] = run.get('seed')
+        result['phases'] = run['phases']
+    except (OSError, ValueError, KeyError):
+        # Stopped before the report was written, such as a failed build
+        result['result'] = 'timed out' if result['exit_status'] is None else 'failed'
+        result['seed'] = None
+        result['phases'] = []
+
+    return result
+
+################### Load tool functions ###################################
+
+def start_registry_process(exe, args):
+    # Starts a registry outside of pexpect for the load tools and returns its
+    # port. Relative paths are from this script, .py files run with python.
+    port = common.get_random_port()
+    if not os.path.isabs(exe):
+        exe = os.path.join(os.path.dirname(os.path.abspath(__file__)), exe)
+    cmd = [exe, str(port)] + args
+    if exe.endswith('.py'):
+        cmd.insert(0, sys.executable)
+
+    reg = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    atexit.register(reg.terminate)
+
+    deadline = time.monotonic() + LOAD_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if reg.poll() is not None:
+            break
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return port
+        except OSError:
+            time.sleep(0.01)
+    raise common.InternalError(f'Registry {os.path.basename(exe)} did not start on port {port}.')
+
+def raise_file_limit():
+    # Each concurrent virtual peer holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
@@ -0,0 +1,295 @@
+import asyncio
+import collections
+import os
+import socket
+import threading
+
+import pexpect
+import pexpect.fdpexpect
+
+import protocol
+
+################### Defined constants ##################################
+# Seconds a partially received message may wait for the rest of its bytes
+# before it is reported as incomplete
+FRAME_IDLE_TIMEOUT = 0.5
+
+# With split_responses, SEARCH responses are forwarded in two writes this
+# many seconds apart, which exposes peers that expect all 10 bytes from a
+# single recv call
+RESPONSE_SPLIT_DELAY = 0.05
+RESPONSE_SPLIT_AT = 4
+
+################### Frame parsing ###################################
+
+class Frame:
+    def __init__(self, action, size, segments):
+        self.action = action
+        self.name = protocol.ACTION_NAMES.get(action, str(action))
+        self.size = size
+        self.segments = segments
+        self.fields = []
+        self.errors = []
+
+    def line(self):
+        # The TEST] line p2_registry prints for this message
+        return b'TEST] ' + b' '.join(map(to_field, [self.name] + self.fields))
+
+def to_field(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+def decode_frame(msg, segments):
+    frame = Frame(msg.action, msg.size, segments)
+    if frame.action == protocol.JOIN:
+        frame.fields = [msg.peer_id]
+    elif frame.action == protocol.REGISTER:
+        frame.fields = [msg.peer_id, f'{msg.ip}:{msg.port}']
+    elif frame.action in (protocol.SEARCH, protocol.FETCH):
+        name = bytes(msg.name)
+        frame.fields = [name]
+        check_name(frame, name)
+    elif frame.action == protocol.PUBLISH:
+        names = [bytes(n) for n in msg.names]
+        frame.fields = [msg.count, b''.join(n + b' ' for n in names)]
+        if frame.size > protocol.MAX_PUBLISH_SIZE:
+            frame.errors.append(f'PUBLISH message is {frame.size} bytes, more than the {protocol.MAX_PUBLISH_SIZE} byte limit.')
+        for name in names:
+            check_name(frame, name)
+    else:
+        frame.errors.append(f'Message with unknown action {frame.action} sent to registry.')
+
+    return frame
+
+def check_name(frame, name):
+    if len(name) + 1 > protocol.MAX_NAME_SIZE:
+        frame.errors.append(f'{frame.name} filename of {len(name) + 1} bytes (with NULL) is more than '
+                            f'the {protocol.MAX_NAME_SIZE} byte limit.')
+    if len(name) == 0:
+        frame.errors.append(f'Empty filename in {frame.name} message.')
+
+class FrameParser:
+    '''Incremental parser for the bytes a peer sends to the registry.'''
+
+    def __init__(self):
+        self.decoder = protocol.StreamDecoder(limit=float('inf'))
+        self.segments = 0
+
+    def pending(self):
+        return self.decoder.pending() > 0
+
+    def feed(self, data):
+        self.decoder.feed(data)
+        self.segments += 1
+        frames = []
+        for msg in self.decoder.messages():
+            frames.append(decode_frame(msg, self.segments))
+            self.segments = 1
+            if msg.action not in protocol.ACTION_NAMES:
+                # Unable to find the next message boundary
+                self.decoder.clear()
+                break
+        if not self.pending():
+            self.segments = 0
+        return frames
+
+    def incomplete(self):
+        buf = self.decoder.partial()
+        action = protocol.ACTION_NAMES.get(buf[0], str(buf[0]))
+        msg = f'Incomplete {action} message, {len(buf)} bytes received'
+        if buf[0] == protocol.PUBLISH and len(buf) >= protocol.PUBLISH_HEADER.size:
+            count, = protocol.COUNT.unpack_from(buf, 1)
+            received = bytes(buf[protocol.PUBLISH_HEADER.size:]).count(b'\0')
+            msg += f', count is {count} but {received} filenames were sent'
+        self.decoder.clear()
+        self.segments = 0
+        return msg + '.'
+
+################### Proxy ###################################
+
+class WireProxy:
+    '''TCP interposer between peers and the registry. Messages from peers are
+    parsed and checked as they arrive, and each complete message is written
+    to write_fd as the TEST] line the registry would print, or an ERROR] line
+    for framing errors. SEARCH lines are written when the response arrives.'''
+
+    def __init__(self, registry_host, registry_port, write_fd, split_responses=False):
+        self.registry_host = registry_host
+        self.registry_port = registry_port
+        self.write_fd = write_fd
+        self.split_responses = split_responses
+        self.port = None
+        self.warnings = []
+        self.loop = None
+        self.stopping = None
+        self.running = False
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        if self.loop is not None and self.running:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join(1)
+
+    def write_line(self, line):
+        view = memoryview(line + b'\r\n')
+        while len(view) > 0:
+            view = view[os.write(self.write_fd, view):]
+
+    def error(self, msg):
+        self.write_line(f'ERROR] (WIRE) {msg}'.encode())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self.handle, host='127.0.0.1', port=0,
+                                                family=socket.AF_INET)
+            self.port = server.sockets[0].getsockname()[1]
+        except OSError as err:
+            self.error(f'Unable to listen: {err.strerror}')
+        else:
+            self.running = True
+            self.started.set()
+            async with server:
+                await self.stopping.wait()
+        finally:
+            self.running = False
+            self.started.set()
+            os.close(self.write_fd)
+
+    async def handle(self, peer_reader, peer_writer):
+        try:
+            reg_reader, reg_writer = await asyncio.open_connection(self.registry_host, self.registry_port)
+        except OSError as err:
+            self.error(f'Unable to connect to registry: {err.strerror}')
+            peer_writer.close()
+            return
+
+        searches = collections.deque()
+        await asyncio.gather(self.peer_to_registry(peer_reader, reg_writer, searches),
+                             self.registry_to_peer(reg_reader, peer_writer, searches))
+
+    async def peer_to_registry(self, reader, writer, searches):
+        parser = FrameParser()
+        try:
+            while True:
+                try:
+                    timeout = FRAME_IDLE_TIMEOUT if parser.pending() else None
+                    data = await asyncio.wait_for(reader.read(65536), timeout)
+                except asyncio.TimeoutError:
+                    self.error(parser.incomplete())
+                    continue
+                if len(data) == 0:
+                    if parser.pending():
+                        self.error(parser.incomplete())
+                    break
+
+                writer.write(data)
+                for frame in parser.feed(data):
+                    if frame.segments > 1:
+                        self.warnings.append(f'{frame.name} message of {frame.size} bytes arrived in '
+                                             f'{frame.segments} segments, send each message with one send call.')
+                    for err in frame.errors:
+                        self.error(err)
+                    if frame.action == protocol.SEARCH:
+                        searches.append(frame)
+                    elif len(frame.errors) == 0:
+                        self.write_line(frame.line())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def registry_to_peer(self, reader, writer, searches):
+        try:
+            while True:
+                try:
+                    response = await reader.readexactly(protocol.SEARCH_RESPONSE_SIZE)
+                except asyncio.IncompleteReadError as err:
+                    if len(err.partial) > 0:
+                        self.error(f'Registry sent {len(err.partial)} unexpected bytes.')
+                    break
+
+                if len(searches) == 0:
+                    self.error('Registry sent a response without a SEARCH request.')
+                else:
+                    frame = searches.popleft()
+                    peer_id, ip, port = protocol.decode_search_response(response)
+                    frame.fields += [peer_id, f'{ip}:{port}']
+                    self.write_line(frame.line())
+
+                if self.split_responses:
+                    writer.write(response[:RESPONSE_SPLIT_AT])
+                    await writer.drain()
+                    await asyncio.sleep(RESPONSE_SPLIT_DELAY)
+                    writer.write(response[RESPONSE_SPLIT_AT:])
+                else:
+                    writer.write(response)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+class WireNode(pexpect.fdpexpect.fdspawn):
+    '''pexpect interface to a WireProxy, used in place of the registry node
+    when verifying messages sent by a peer. Output of the real registry is
+    drained when reading and its ERROR] lines are passed on.'''
+
+    def __init__(self, proxy, registry, fd, **kwargs):
+        super().__init__(fd, **kwargs)
+        self.proxy = proxy
+        self.port = proxy.port
+        self.registry = registry
+        self.registry_partial = ''
+        self.registry_closed = False
+        self.exitstatus = None
+
+    def isalive(self):
+        return self.proxy.running and super().isalive()
+
+    def terminate(self, force=False):
+        self.proxy.stop()
+        return True
+
+    def wait_fds(self):
+        # Registry errors are passed on as they arrive
+        if self.registry_closed:
+            return [self.child_fd]
+        return [self.child_fd, self.registry.child_fd]
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        errors = self.drain_registry()
+        if len(errors) > 0:
+            return errors
+        return super().read_nonblocking(size, timeout)
+
+    def drain_registry(self):
+        if self.registry_closed:
+            return ''
+        data = ''
+        try:
+            while True:
+                data += self.registry.read_nonblocking(self.registry.maxread, 0)
+        except pexpect.TIMEOUT:
+            pass
+        except pexpect.EOF:
+            self.registry_closed = True
+            data += '\r\nERROR] (WIRE) Registry unexpectedly closed.\r\n'
+        *lines, self.registry_partial = (self.registry_partial + data).split('\r\n')
+
+        return ''.join(line + '\r\n' for line in lines if 'ERROR]' in line)
+
+def start(registry, host, port, timeout, split_responses=False, logfile=None):
+    read_fd, write_fd = os.pipe()
+    proxy = WireProxy(host, port, write_fd, split_responses=split_responses)
+    proxy.start()
+
+    return WireNode(proxy, registry, read_fd, timeout=timeout, encoding='utf-8', logfile=logfile)